@@ -1,15 +1,44 @@
-from flask import Flask, request, render_template, send_file, jsonify
+from flask import Flask, request, render_template, send_file, jsonify, Response
 import subprocess
 import csv
-import tempfile
+import binascii
+import io
+import mmap
 import os
+import re
+import zipfile
 import json
 import hashlib
+import hmac
+import sqlite3
+import secrets
+import struct
+import zlib
+import importlib.metadata
+import multiprocessing
+import atexit
+import random
+import queue
+from urllib.parse import quote, urlencode
 from datetime import datetime, timedelta
 import serial.tools.list_ports
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 import requests
-from threading import Thread, Lock
+from requests.adapters import HTTPAdapter
+from threading import Thread, Lock, RLock, Event, Condition, get_native_id
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import time
+from esp_idf_nvs_partition_gen import nvs_partition_gen as nvs_gen
+try:
+    import detools  # firmware deltas; optional
+except ImportError:
+    detools = None
+try:
+    import fcntl  # cross-process download locks; POSIX only
+except ImportError:
+    fcntl = None
 
 # --- GitHub Firmware Configuration ---
 FIRMWARE_REPOS = {
@@ -48,7 +77,678 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 
 # Global firmware manager instances
 firmware_managers = {}
-firmware_lock = Lock()
+
+# ---------- GitHub API Client ----------
+
+GITHUB_API = "https://api.github.com"
+GITHUB_CACHE_DIR = os.environ.get('GITHUB_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'github_cache'))
+GITHUB_FRESH_SECONDS = 30      # reuse a response without revalidating inside this window
+GITHUB_RATE_LIMIT_RESERVE = 5  # stop calling the API this many requests before exhaustion
+GITHUB_SHARE_SECONDS = 2       # even forced refreshes reuse a response this recent
+
+class GitHubRateLimited(Exception):
+    def __init__(self, reset_at):
+        self.reset_at = reset_at
+        wait_s = max(int(reset_at - time.time()), 0)
+        super().__init__(f"GitHub API rate limit nearly exhausted, retry in {wait_s // 60}m {wait_s % 60}s")
+
+class GitHubClient:
+    """Keep-alive session with on-disk ETag caching and rate-limit tracking.
+
+    Responses are stored with their ETag and revalidated with If-None-Match, so an
+    unchanged release list comes back as a 304 and costs nothing but a round trip.
+    Calls are single-flight per URL (repo + endpoint): concurrent callers wait for the one
+    request in flight and share its result, so N tablets pressing Check cost one request.
+    """
+
+    def __init__(self, cache_dir=GITHUB_CACHE_DIR, token=None):
+        self.cache_dir = cache_dir
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=len(FIRMWARE_REPOS) + 4)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept': 'application/vnd.github+json', 'User-Agent': 'bonicbot-nvs-webusb'})
+        token = token or os.environ.get('GITHUB_TOKEN')
+        if token:
+            self.session.headers['Authorization'] = f'Bearer {token}'
+        self._cache = {}
+        self._inflight = {}  # url -> (done Event, [body or exception])
+        self._lock = Lock()
+        self.rate_limit = {'limit': None, 'remaining': None, 'reset': None}
+        self.counters = {'requests': 0, 'fetched': 0, 'not_modified': 0, 'fresh_hits': 0, 'shared': 0,
+                         'coalesced': 0, 'stale_served': 0, 'refused': 0, 'errors': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _cache_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode()).hexdigest()[:32] + '.json')
+
+    def _cached(self, url):
+        if url not in self._cache:
+            try:
+                with open(self._cache_path(url), 'r') as f:
+                    self._cache[url] = json.load(f)
+            except (OSError, ValueError):
+                self._cache[url] = None
+        return self._cache[url]
+
+    def _store(self, url, entry):
+        self._cache[url] = entry
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._cache_path(url)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(entry, f)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            print(f"⚠️  Warning: Could not cache GitHub response: {e}")
+
+    def _update_rate_limit(self, response):
+        headers = response.headers
+        if 'X-RateLimit-Remaining' in headers:
+            with self._lock:
+                self.rate_limit = {'limit': int(headers.get('X-RateLimit-Limit', 0)),
+                                   'remaining': int(headers['X-RateLimit-Remaining']),
+                                   'reset': int(headers.get('X-RateLimit-Reset', 0))}
+
+    def _rate_limited(self):
+        remaining, reset = self.rate_limit['remaining'], self.rate_limit['reset']
+        return remaining is not None and remaining <= GITHUB_RATE_LIMIT_RESERVE and time.time() < (reset or 0)
+
+    def get_json(self, path, timeout=15, fresh_for=GITHUB_FRESH_SECONDS):
+        """GET an API path (or full URL) and return the decoded JSON body."""
+        url = path if path.startswith('http') else GITHUB_API + path
+        cached = self._cached(url)
+        if cached:
+            age = time.time() - cached['fetched_at']
+            if age < fresh_for:
+                self._count('fresh_hits')
+                return cached['body']
+            if age < GITHUB_SHARE_SECONDS:
+                self._count('shared')
+                return cached['body']
+
+        with self._lock:
+            flight = self._inflight.get(url)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[url] = (Event(), [])
+        done, outcome = flight
+        if not leader:
+            self._count('coalesced')
+            if not done.wait(timeout * 2):
+                raise requests.exceptions.Timeout(f"Timed out waiting for in-flight request to {url}")
+            if isinstance(outcome[0], BaseException):
+                raise outcome[0]
+            return outcome[0]
+        try:
+            cached = self._cached(url)
+            if cached and time.time() - cached['fetched_at'] < GITHUB_SHARE_SECONDS:
+                # A flight that landed between our cache check and taking the lead already answered this
+                self._count('shared')
+                outcome.append(cached['body'])
+            else:
+                outcome.append(self._fetch(url, cached, timeout))
+            return outcome[0]
+        except BaseException as e:
+            outcome.append(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[url]
+            done.set()
+
+    def _fetch(self, url, cached, timeout):
+        """The upstream request behind get_json (one per URL at a time)."""
+        if self._rate_limited():
+            if cached:
+                self._count('stale_served')
+                return cached['body']
+            self._count('refused')
+            raise GitHubRateLimited(self.rate_limit['reset'])
+
+        headers = {'If-None-Match': cached['etag']} if cached and cached.get('etag') else {}
+        self._count('requests')
+        try:
+            response = self.session.get(url, headers=headers, timeout=timeout)
+        except requests.exceptions.RequestException:
+            self._count('errors')
+            raise
+        self._update_rate_limit(response)
+        if response.status_code == 304 and cached:
+            self._count('not_modified')
+            cached['fetched_at'] = time.time()
+            self._store(url, cached)
+            return cached['body']
+        if response.status_code in (403, 429) and self.rate_limit['remaining'] == 0:
+            self._count('refused')
+            if cached:
+                self._count('stale_served')
+                return cached['body']
+            raise GitHubRateLimited(self.rate_limit['reset'])
+        try:
+            response.raise_for_status()
+        except requests.exceptions.RequestException:
+            self._count('errors')
+            raise
+        body = response.json()
+        self._count('fetched')
+        self._store(url, {'etag': response.headers.get('ETag'), 'fetched_at': time.time(), 'body': body})
+        return body
+
+    def status(self):
+        with self._lock:
+            return {'counters': dict(self.counters), 'rate_limit': dict(self.rate_limit),
+                    'rate_limited': self._rate_limited(),
+                    'cached_responses': sum(1 for entry in self._cache.values() if entry)}
+
+github = GitHubClient()
+
+# ---------- Release Catalog ----------
+
+# Every published release of a repo, persisted under data/releases. The first sync walks all
+# pages; later ones read pages newest-first only until a known release shows up, since
+# published releases don't change. Within the TTL (and whenever GitHub is unreachable) the
+# stored list is served as is, so version lists and release notes work offline.
+RELEASE_CATALOG_DIR = os.environ.get('RELEASE_CATALOG_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'releases'))
+RELEASE_CATALOG_TTL = int(os.environ.get('RELEASE_CATALOG_TTL', 900))
+RELEASE_CATALOG_FULL_SYNC = 7 * 24 * 3600  # re-walk all pages weekly to pick up deletions
+RELEASE_PAGE_SIZE = 100
+
+class ReleaseCatalog:
+    def __init__(self, owner, repo, root=RELEASE_CATALOG_DIR, ttl=RELEASE_CATALOG_TTL):
+        self.owner = owner
+        self.repo = repo
+        self.path = os.path.join(root, f"{owner}__{repo}.json")
+        self.ttl = ttl
+        self.last_error = None
+        self._error = None  # exception behind last_error, re-raised while there is no catalog
+        self._failed_at = 0
+        self._data = None
+        self._lock = Lock()
+
+    def _load(self):
+        if self._data is None:
+            try:
+                with open(self.path) as f:
+                    self._data = json.load(f)
+            except (OSError, ValueError):
+                self._data = {'releases': [], 'refreshed_at': 0, 'full_sync_at': 0}
+        return self._data
+
+    @staticmethod
+    def _trim(release):
+        """The release fields the app uses (the raw API objects are ~10x larger)."""
+        return {'id': release['id'], 'tag_name': release['tag_name'], 'name': release.get('name'),
+                'published_at': release.get('published_at'), 'body': release.get('body') or '',
+                'prerelease': release.get('prerelease', False),
+                'assets': [{'name': a['name'], 'browser_download_url': a['browser_download_url'], 'size': a['size']}
+                           for a in release.get('assets', [])]}
+
+    def _sync(self, data, fresh_for, timeout):
+        full = time.time() - data['full_sync_at'] >= RELEASE_CATALOG_FULL_SYNC
+        known = set() if full else {release['id'] for release in data['releases']}
+        new = []
+        page = 1
+        while True:
+            batch = github.get_json(f"/repos/{self.owner}/{self.repo}/releases?per_page={RELEASE_PAGE_SIZE}&page={page}",
+                                    fresh_for=fresh_for, timeout=timeout)
+            unseen = [release for release in batch if release['id'] not in known]
+            new.extend(self._trim(release) for release in unseen if not release.get('draft'))
+            if len(unseen) < len(batch) or len(batch) < RELEASE_PAGE_SIZE:
+                break
+            page += 1
+        now = time.time()
+        data.update(releases=new if full else new + data['releases'], refreshed_at=now)
+        if full:
+            data['full_sync_at'] = now
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        _write_json_atomic(self.path, data)
+        return len(new), page
+
+    def releases(self, refresh=False, timeout=15):
+        """Releases newest first. Syncs when the TTL ran out (or refresh=True); if GitHub
+        can't be reached the persisted list is returned, and only an empty one raises.
+        `timeout` applies to each GitHub request of the sync."""
+        with self._lock:
+            data = self._load()
+            now = time.time()
+            stale = now - data['refreshed_at'] >= self.ttl and now - self._failed_at >= 60
+            # Callers that queued on the lock behind a refresh share its result
+            if (refresh and now - data['refreshed_at'] >= GITHUB_SHARE_SECONDS) or stale:
+                try:
+                    self._sync(data, fresh_for=0 if refresh else GITHUB_FRESH_SECONDS, timeout=timeout)
+                    self.last_error, self._error = None, None
+                except (GitHubRateLimited, requests.exceptions.RequestException, ValueError, KeyError) as e:
+                    self.last_error, self._error = str(e), e
+                    self._failed_at = now
+                    if not data['full_sync_at']:
+                        raise
+                    print(f"⚠️  Using cached release catalog for {self.owner}/{self.repo}: {e}")
+            elif not data['full_sync_at'] and self._error is not None:
+                # Backing off after a failed first sync: an empty list would read as "no releases"
+                raise self._error
+            return data['releases']
+
+    def find(self, tag):
+        """A release by tag from the persisted catalog (never touches the network)."""
+        with self._lock:
+            return next((release for release in self._load()['releases'] if release['tag_name'] == tag), None)
+
+    def status(self):
+        with self._lock:
+            data = self._load()
+            return {'releases': len(data['releases']), 'refreshed_at': data['refreshed_at'],
+                    'full_sync_at': data['full_sync_at'], 'ttl': self.ttl, 'last_error': self.last_error}
+
+_release_catalogs = {}
+
+def release_catalog(owner, repo):
+    """One catalog per repo, shared by every bot built from it."""
+    return _release_catalogs.setdefault((owner, repo), ReleaseCatalog(owner, repo))
+
+_download_locks = {}
+_download_locks_lock = Lock()
+
+def _write_json_atomic(path, data):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+def _link_into_place(src, dst):
+    """Atomically make dst refer to src's bytes without copying them."""
+    tmp = dst + '.activating'
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        try:
+            os.symlink(os.path.relpath(src, os.path.dirname(dst)), tmp)
+        except OSError:
+            import shutil
+            shutil.copy2(src, tmp)  # last resort (e.g. FAT without symlinks); still swapped atomically
+    os.replace(tmp, dst)
+
+# Firmware digests live in sidecars next to each versions/<v>.bin, in `sha256sum` / `md5sum`
+# format, so a binary is hashed once (while it downloads) and never re-read for its hash.
+def _hash_file(path):
+    sha256, md5 = hashlib.sha256(), hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+            md5.update(chunk)
+    return sha256, md5
+
+def write_digests(bin_path, sha256, md5):
+    name = os.path.basename(bin_path)
+    for suffix, digest in (('.sha256', sha256), ('.md5', md5)):
+        with open(bin_path + suffix + '.tmp', 'w') as f:
+            f.write(f"{digest}  {name}\n")
+        os.replace(bin_path + suffix + '.tmp', bin_path + suffix)
+
+def read_digests(bin_path):
+    """{'sha256', 'md5'} from the sidecars, or None if either is missing."""
+    try:
+        with open(bin_path + '.sha256') as f:
+            sha256 = f.read().split()[0]
+        with open(bin_path + '.md5') as f:
+            md5 = f.read().split()[0]
+        return {'sha256': sha256, 'md5': md5}
+    except (OSError, IndexError):
+        return None
+
+def file_digests(bin_path):
+    """Sidecar digests; a binary that predates sidecars is hashed once (streamed) and recorded."""
+    digests = read_digests(bin_path)
+    if digests is None:
+        sha256, md5 = _hash_file(bin_path)
+        digests = {'sha256': sha256.hexdigest(), 'md5': md5.hexdigest()}
+        write_digests(bin_path, digests['sha256'], digests['md5'])
+    return digests
+
+def version_key(version):
+    """Semantic-version sort key: v1.0.10 > v1.0.9 and v1.1.0-rc1 < v1.1.0. Tags that
+    aren't versions sort below all versions, by name."""
+    m = re.match(r'v?(\d+)(?:\.(\d+))?(?:\.(\d+))?(?:-([0-9A-Za-z.-]+))?', version or '')
+    if not m:
+        return (0, (), (), version or '')
+    pre = m.group(4)
+    pre_key = (1,) if pre is None else (0,) + tuple((0, int(p), '') if p.isdigit() else (1, 0, p) for p in pre.split('.'))
+    return (1, tuple(int(n or 0) for n in m.group(1, 2, 3)), pre_key, version)
+
+def _download_lock(path):
+    """One lock per target file, shared by activation and the prefetcher."""
+    with _download_locks_lock:
+        return _download_locks.setdefault(path, Lock())
+
+@contextmanager
+def _process_file_lock(path):
+    """Exclusive flock on `path` (created if missing), held across processes such as a second
+    server instance or the debug reloader's watcher. A no-op where fcntl is unavailable."""
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+# ---------- Firmware Blob Store ----------
+
+# Every cached firmware and boot binary is a hardlink to one blob under data/firmware_store,
+# named by its SHA-256, so identical images (re-tagged releases, bootloaders shared between
+# bots) take their space once. The SQLite index maps refs (bot, kind, name) to blobs and
+# counts them; a blob is deleted with its last ref. Only cached deltas and unpinned 'version'
+# refs are ever evicted for the quota, and never a bot's active version. Keep the store on
+# the same filesystem as static/, otherwise links fall back to symlinks.
+FIRMWARE_STORE_DIR = os.environ.get('FIRMWARE_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'firmware_store'))
+FIRMWARE_STORE_QUOTA = int(os.environ.get('FIRMWARE_STORE_QUOTA', 512 * 1024 * 1024))
+FIRMWARE_STORE_POLICY = os.environ.get('FIRMWARE_STORE_POLICY', 'lru')  # 'lru' or 'oldest'
+
+# Deltas are detools "sequential" patches, the format ESP-IDF's esp_delta_ota applies on
+# the device (heatshrink by default). They are keyed by the two blob hashes, so a cached
+# delta never goes stale, and live in the store until either blob is dropped. Their bytes
+# count toward the quota, and least recently used deltas are evicted before any version.
+DELTA_COMPRESSIONS = ('heatshrink', 'lzma', 'zstd', 'none')
+
+class FirmwareStore:
+    def __init__(self, root=FIRMWARE_STORE_DIR, quota=FIRMWARE_STORE_QUOTA, policy=FIRMWARE_STORE_POLICY):
+        self.root = root
+        self.quota = quota
+        self.policy = policy
+        self.path = os.path.join(root, 'index.sqlite3')
+        self._conn = None
+        self._lock = Lock()
+        self._delta_locks = {}  # delta name -> [Lock, holders]; dropped when the last holder leaves
+        self._delta_locks_lock = Lock()
+
+    def _db(self):
+        if self._conn is None:
+            os.makedirs(self.root, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS blobs (sha256 TEXT PRIMARY KEY, size INTEGER NOT NULL, added_at REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS refs (
+                    bot TEXT NOT NULL, kind TEXT NOT NULL, name TEXT NOT NULL,
+                    sha256 TEXT NOT NULL, path TEXT NOT NULL, pinned INTEGER NOT NULL DEFAULT 0,
+                    added_at REAL NOT NULL, last_used REAL NOT NULL,
+                    PRIMARY KEY (bot, kind, name));
+                CREATE INDEX IF NOT EXISTS refs_sha256 ON refs (sha256);
+                CREATE TABLE IF NOT EXISTS deltas (
+                    name TEXT PRIMARY KEY, from_sha256 TEXT NOT NULL, to_sha256 TEXT NOT NULL,
+                    size INTEGER NOT NULL, last_used REAL NOT NULL);
+            """)
+            self._conn = conn
+        return self._conn
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            db = self._db()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+    def blob_path(self, sha256):
+        return os.path.join(self.root, 'blobs', sha256[:2], f"{sha256}.bin")
+
+    def add(self, bot, kind, name, path, sha256=None):
+        """Record `path` as a ref, moving its bytes into the store or, if an identical blob
+        is already there, replacing the file with a link to that blob."""
+        sha256 = sha256 or _hash_file(path)[0].hexdigest()
+        blob = self.blob_path(sha256)
+        now = time.time()
+        with self._transaction() as db:
+            if not os.path.exists(blob):
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                try:
+                    os.link(path, blob)
+                except OSError:
+                    import shutil
+                    shutil.copy2(path, blob + '.tmp')
+                    os.replace(blob + '.tmp', blob)
+            if not os.path.samefile(blob, path):
+                _link_into_place(blob, path)
+            db.execute('INSERT OR IGNORE INTO blobs VALUES (?, ?, ?)', (sha256, os.path.getsize(blob), now))
+            old = db.execute('SELECT sha256 FROM refs WHERE bot = ? AND kind = ? AND name = ?', (bot, kind, name)).fetchone()
+            db.execute('INSERT INTO refs VALUES (?, ?, ?, ?, ?, 0, ?, ?) ON CONFLICT (bot, kind, name) '
+                       'DO UPDATE SET sha256 = excluded.sha256, path = excluded.path',
+                       (bot, kind, name, sha256, path, now, now))
+            if old and old[0] != sha256:
+                self._drop_if_unreferenced(db, old[0])
+        firmware_catalog.invalidate()
+        return sha256
+
+    def adopt(self, bot, kind, name, path):
+        """add() for a file found on disk; skips hashing when it already is its blob."""
+        with self._lock:
+            row = self._db().execute('SELECT sha256 FROM refs WHERE bot = ? AND kind = ? AND name = ?',
+                                     (bot, kind, name)).fetchone()
+        try:
+            if row and os.path.samefile(self.blob_path(row[0]), path):
+                return row[0]
+        except OSError:
+            pass
+        sha256 = file_digests(path)['sha256'] if kind == 'version' else None
+        return self.add(bot, kind, name, path, sha256)
+
+    def _drop_if_unreferenced(self, db, sha256):
+        if db.execute('SELECT 1 FROM refs WHERE sha256 = ? LIMIT 1', (sha256,)).fetchone() is None:
+            db.execute('DELETE FROM blobs WHERE sha256 = ?', (sha256,))
+            db.execute('DELETE FROM deltas WHERE from_sha256 = ? OR to_sha256 = ?', (sha256, sha256))
+            try:
+                os.unlink(self.blob_path(sha256))
+            except FileNotFoundError:
+                pass
+            delta_dir = os.path.join(self.root, 'deltas')
+            for name in os.listdir(delta_dir) if os.path.isdir(delta_dir) else ():
+                if sha256 in name:
+                    os.unlink(os.path.join(delta_dir, name))
+
+    def version_sha256(self, bot, version):
+        with self._lock:
+            row = self._db().execute("SELECT sha256 FROM refs WHERE bot = ? AND kind = 'version' AND name = ?",
+                                     (bot, version)).fetchone()
+        return row[0] if row else None
+
+    def delta(self, from_sha256, to_sha256, compression='heatshrink'):
+        """(metadata, patch path) for the delta between two blobs, built on first use.
+
+        A new patch is applied back onto the source before it is cached and must reproduce
+        the target's SHA-256, so a served delta is known to reconstruct the image."""
+        name = f"{from_sha256}_{to_sha256}.{compression}"
+        stem = os.path.join(self.root, 'deltas', name)
+        patch_path, meta_path = stem + '.patch', stem + '.json'
+        with self._delta_lock(name):
+            if os.path.exists(meta_path) and os.path.exists(patch_path):
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                self._record_delta(name, from_sha256, to_sha256, patch_path, meta_path)
+                return meta, patch_path
+            if detools is None:
+                raise RuntimeError('detools is not installed')
+            started = time.perf_counter()
+            patch = io.BytesIO()
+            with open(self.blob_path(from_sha256), 'rb') as ffrom, open(self.blob_path(to_sha256), 'rb') as fto:
+                detools.create_patch(ffrom, fto, patch, compression=compression, patch_type='sequential')
+                ffrom.seek(0)
+                rebuilt = io.BytesIO()
+                detools.apply_patch(ffrom, io.BytesIO(patch.getvalue()), rebuilt)
+            if hashlib.sha256(rebuilt.getvalue()).hexdigest() != to_sha256:
+                raise RuntimeError('Delta does not reconstruct the target image')
+            data = patch.getvalue()
+            os.makedirs(os.path.dirname(stem), exist_ok=True)
+            with open(patch_path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(patch_path + '.tmp', patch_path)
+            meta = {'from_sha256': from_sha256, 'to_sha256': to_sha256,
+                    'to_md5': hashlib.md5(rebuilt.getvalue()).hexdigest(), 'to_size': len(rebuilt.getvalue()),
+                    'size': len(data), 'sha256': hashlib.sha256(data).hexdigest(),
+                    'compression': compression, 'patch_type': 'sequential', 'verified': True,
+                    'build_ms': round((time.perf_counter() - started) * 1000, 1)}
+            _write_json_atomic(meta_path, meta)
+            self._record_delta(name, from_sha256, to_sha256, patch_path, meta_path)
+            return meta, patch_path
+
+    @contextmanager
+    def _delta_lock(self, name, blocking=True):
+        """Per-delta lock (build vs. build, build vs. eviction); yields whether it was taken."""
+        with self._delta_locks_lock:
+            entry = self._delta_locks.setdefault(name, [Lock(), 0])
+            entry[1] += 1
+        acquired = entry[0].acquire(blocking)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                entry[0].release()
+            with self._delta_locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._delta_locks[name]
+
+    def _record_delta(self, name, from_sha256, to_sha256, patch_path, meta_path):
+        """Count a delta's files toward usage and mark it used (also adopts deltas from before the index)."""
+        size = os.path.getsize(patch_path) + os.path.getsize(meta_path)
+        with self._transaction() as db:
+            db.execute('INSERT INTO deltas VALUES (?, ?, ?, ?, ?) ON CONFLICT (name) '
+                       'DO UPDATE SET size = excluded.size, last_used = excluded.last_used',
+                       (name, from_sha256, to_sha256, size, time.time()))
+
+    def _evict_deltas(self, usage):
+        """Drop least recently used deltas until `usage` fits the quota; returns (evicted, usage)."""
+        with self._lock:
+            candidates = self._db().execute('SELECT name, size FROM deltas ORDER BY last_used').fetchall()
+        evicted = []
+        for name, size in candidates:
+            if usage <= self.quota:
+                break
+            with self._delta_lock(name, blocking=False) as acquired:
+                if not acquired:
+                    continue  # being built or read right now
+                for suffix in ('.patch', '.json'):
+                    try:
+                        os.unlink(os.path.join(self.root, 'deltas', name + suffix))
+                    except FileNotFoundError:
+                        pass
+                with self._transaction() as db:
+                    db.execute('DELETE FROM deltas WHERE name = ?', (name,))
+            evicted.append({'delta': name, 'reclaimed_bytes': size})
+            usage -= size
+        return evicted, usage
+
+    def remove(self, bot, kind, name):
+        with self._transaction() as db:
+            row = db.execute('SELECT sha256 FROM refs WHERE bot = ? AND kind = ? AND name = ?', (bot, kind, name)).fetchone()
+            if row:
+                db.execute('DELETE FROM refs WHERE bot = ? AND kind = ? AND name = ?', (bot, kind, name))
+                self._drop_if_unreferenced(db, row[0])
+        firmware_catalog.invalidate()
+
+    def prune(self, bot):
+        """Forget refs of a bot whose files were deleted by hand."""
+        with self._lock:
+            rows = self._db().execute('SELECT kind, name, path FROM refs WHERE bot = ?', (bot,)).fetchall()
+        for kind, name, path in rows:
+            if not os.path.exists(path):
+                self.remove(bot, kind, name)
+
+    def touch(self, bot, version):
+        with self._transaction() as db:
+            db.execute("UPDATE refs SET last_used = ? WHERE bot = ? AND kind = 'version' AND name = ?",
+                       (time.time(), bot, version))
+
+    def pin(self, bot, version, pinned=True):
+        """Pin (or unpin) a cached version; False if it isn't in the store."""
+        with self._transaction() as db:
+            found = db.execute("UPDATE refs SET pinned = ? WHERE bot = ? AND kind = 'version' AND name = ?",
+                               (int(pinned), bot, version)).rowcount > 0
+        firmware_catalog.invalidate(bot)
+        return found
+
+    def pinned(self, bot):
+        with self._lock:
+            return sorted(row[0] for row in self._db().execute(
+                "SELECT name FROM refs WHERE bot = ? AND kind = 'version' AND pinned = 1", (bot,)))
+
+    def usage(self):
+        """Bytes on disk: blobs plus cached deltas."""
+        with self._lock:
+            return self._db().execute('SELECT (SELECT COALESCE(SUM(size), 0) FROM blobs) + '
+                                      '(SELECT COALESCE(SUM(size), 0) FROM deltas)').fetchone()[0]
+
+    def enforce_quota(self, keep=()):
+        """Evict unpinned, inactive versions (LRU or oldest first) until usage fits the quota.
+        Evicting a version deletes versions/<v>.bin and its sidecars; refs in `keep` stay.
+        A version whose blob is also referenced elsewhere frees nothing, so it is skipped.
+        Cached deltas are cheaper to rebuild than a download, so they go first."""
+        usage = self.usage()
+        if usage <= self.quota:
+            return []
+        evicted, usage = self._evict_deltas(usage)
+        if usage <= self.quota:
+            return evicted
+        order = 'last_used' if self.policy == 'lru' else 'added_at'
+        with self._lock:
+            candidates = self._db().execute(
+                f"SELECT bot, name, path, sha256, size FROM refs JOIN blobs USING (sha256) "
+                f"WHERE kind = 'version' AND pinned = 0 ORDER BY refs.{order}").fetchall()
+        for bot, name, path, sha256, size in candidates:
+            if (bot, name) in keep or self._ref_count(sha256) > 1:
+                continue
+            manager = firmware_managers.get(bot)
+            with manager.lock if manager else Lock():
+                if manager and manager.current_version == name:
+                    continue
+                download_lock = _download_lock(path)
+                if not download_lock.acquire(blocking=False):
+                    continue  # being fetched or re-linked right now
+                try:
+                    if self._ref_count(sha256) > 1:
+                        continue  # another ref picked up this blob meanwhile
+                    for suffix in ('', '.sha256', '.md5'):
+                        try:
+                            os.unlink(path + suffix)
+                        except FileNotFoundError:
+                            pass
+                    try:
+                        os.unlink(os.path.splitext(path)[0] + '.json')
+                    except FileNotFoundError:
+                        pass
+                    self.remove(bot, 'version', name)
+                finally:
+                    download_lock.release()
+            evicted.append({'bot': bot, 'version': name, 'reclaimed_bytes': size})
+            print(f"🧹 Evicted cached firmware {bot} {name} (store over quota)")
+            usage -= size
+            if usage <= self.quota:
+                break
+        return evicted
+
+    def _ref_count(self, sha256):
+        with self._lock:
+            return self._db().execute('SELECT COUNT(*) FROM refs WHERE sha256 = ?', (sha256,)).fetchone()[0]
+
+    def stats(self):
+        with self._lock:
+            db = self._db()
+            blobs, stored = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs').fetchone()
+            refs, logical = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM refs JOIN blobs USING (sha256)').fetchone()
+            deltas, delta_bytes = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM deltas').fetchone()
+        return {'blobs': blobs, 'refs': refs, 'stored_bytes': stored, 'logical_bytes': logical,
+                'dedup_saved_bytes': logical - stored, 'deltas': deltas, 'delta_bytes': delta_bytes,
+                'usage_bytes': stored + delta_bytes, 'quota_bytes': self.quota, 'policy': self.policy}
+
+firmware_store = FirmwareStore()
 
 class FirmwareManager:
     def __init__(self, bot_name, repo_owner, repo_name, asset_name):
@@ -62,7 +762,11 @@ class FirmwareManager:
         self.check_interval = 3600  # Check every hour (in seconds)
         self.last_check_time = 0
         self.current_version = None
-        self.is_checking = False
+        self.current_hash = None
+        self.current_md5 = None
+        self.lock = RLock()  # activation: served file, metadata and in-memory state
+        self.release_catalog = release_catalog(repo_owner, repo_name)
+        self._manifests = LruCache(8)  # (version, digests) -> (json bytes, etag)
         
         # Load existing metadata
         self._load_metadata()
@@ -77,153 +781,132 @@ class FirmwareManager:
                 with open(self.metadata_path, 'r') as f:
                     metadata = json.load(f)
                     self.current_version = metadata.get('version')
+                    self.current_hash = metadata.get('hash')
+                    self.current_md5 = metadata.get('md5')
                     self.last_check_time = metadata.get('last_check', 0)
-                    # Repair stale manifest on startup
-                    if self.current_version:
-                        self._generate_manifest(self.current_version)
                     return metadata
         except Exception as e:
             print(f"⚠️  Warning: Could not load firmware metadata for {self.bot_name}: {e}")
         return {}
 
-    def _generate_manifest(self, version):
-        """Regenerate manifest.json so esp-web-tools always flashes the correct binary."""
-        try:
-            os.makedirs(self.static_dir, exist_ok=True)
+    def manifest(self):
+        """(json bytes, etag) of the esp-web-tools manifest for the active version.
 
-            # Some bots (e.g. S1-Head) ship their own bootloader/partitions
-            own_bootloader = FIRMWARE_REPOS.get(self.bot_name, {}).get('own_bootloader', False)
-            if own_bootloader:
-                stem = os.path.splitext(self.asset_name)[0]  # e.g. "headPCB"
-                bootloader_path = f"/static/{self.bot_name}/{stem}.ino.bootloader.bin"
-                partitions_path = f"/static/{self.bot_name}/{stem}.ino.partitions.bin"
-            else:
-                bootloader_path = "/static/mainPCB.ino.bootloader.bin"
-                partitions_path = "/static/mainPCB.ino.partitions.bin"
-
-            # Always point to the canonical asset file (never versioned paths).
-            # The ?v= query param busts the browser cache whenever the version changes,
-            # preventing stale binaries from being flashed via esp-web-tools.
-            v_slug = (version or "unknown").replace(" ", "_")
-            firmware_path = f"/static/{self.bot_name}/{self.asset_name}?v={v_slug}"
-
-            manifest = {
-                "name": f"{self.bot_name} Firmware",
-                "version": version or "Unknown",
-                "new_install_prompt_erase": True,
-                "builds": [
-                    {
-                        "chipFamily": "ESP32-S3",
-                        "parts": [
-                            {"path": bootloader_path, "offset": 0},
-                            {"path": partitions_path, "offset": 32768},
-                            {"path": firmware_path, "offset": 65536}
-                        ]
-                    }
-                ]
-            }
+        Rendered from in-memory state on first request and kept per (version, digests), so
+        nothing is written to static/ and a swap back to an earlier version reuses its bytes."""
+        with self.lock:
+            version, digests = self.current_version, self.digest_fields()
+        key = (version, tuple(sorted(digests.items())))
+        cached = self._manifests.get(key)
+        if cached:
+            return cached
 
-            manifest_path = os.path.join(self.static_dir, 'manifest.json')
-            with open(manifest_path, 'w') as f:
-                json.dump(manifest, f, indent=2)
-            print(f"✅ Manifest updated for {self.bot_name} → {version}")
-        except Exception as e:
-            print(f"⚠️  Warning: Could not update manifest for {self.bot_name}: {e}")
+        bootloader_path, partitions_path = self.boot_files()
+
+        # Always point to the canonical asset file (never versioned paths).
+        # The ?v= query param busts the browser cache whenever the version changes,
+        # preventing stale binaries from being flashed via esp-web-tools.
+        v_slug = (version or "unknown").replace(" ", "_")
+        firmware_path = f"/static/{self.bot_name}/{self.asset_name}?v={v_slug}"
+        app_part = {"path": firmware_path, "offset": 65536}
+        app_part.update(digests)
+
+        manifest = {
+            "name": f"{self.bot_name} Firmware",
+            "version": version or "Unknown",
+            "new_install_prompt_erase": True,
+            "builds": [
+                {
+                    "chipFamily": "ESP32-S3",
+                    "parts": [
+                        {"path": bootloader_path, "offset": 0},
+                        {"path": partitions_path, "offset": 32768},
+                        app_part
+                    ]
+                }
+            ]
+        }
+
+        body = json.dumps(manifest, indent=2).encode()
+        cached = (body, hashlib.sha256(body).hexdigest())
+        self._manifests.put(key, cached)
+        return cached
     
+    def boot_files(self):
+        """Static URLs of the bootloader and partition table flashed with this bot's app."""
+        # Some bots (e.g. S1-Head) ship their own bootloader/partitions
+        if FIRMWARE_REPOS.get(self.bot_name, {}).get('own_bootloader', False):
+            stem = os.path.splitext(self.asset_name)[0]  # e.g. "headPCB"
+            return (f"/static/{self.bot_name}/{stem}.ino.bootloader.bin",
+                    f"/static/{self.bot_name}/{stem}.ino.partitions.bin")
+        return "/static/mainPCB.ino.bootloader.bin", "/static/mainPCB.ino.partitions.bin"
+
+    def digest_fields(self):
+        """sha256/md5 of the active image for manifest parts (whichever are known)."""
+        return {k: v for k, v in (('sha256', self.current_hash), ('md5', self.current_md5)) if v}
+
     def _save_metadata(self, metadata):
         """Save firmware metadata to local file."""
         try:
             os.makedirs(self.static_dir, exist_ok=True)
-            with open(self.metadata_path, 'w') as f:
-                json.dump(metadata, f, indent=2)
+            _write_json_atomic(self.metadata_path, metadata)
         except Exception as e:
             print(f"⚠️  Warning: Could not save firmware metadata for {self.bot_name}: {e}")
     
-    def _get_file_hash(self, file_path):
-        """Calculate SHA256 hash of a file."""
-        try:
-            with open(file_path, 'rb') as f:
-                return hashlib.sha256(f.read()).hexdigest()
-        except:
-            return None
-    
+    def _release_entry(self, release):
+        """Release fields used by the UI, or None if it doesn't carry our asset."""
+        for asset in release.get('assets', []):
+            if asset['name'] == self.asset_name:
+                return {
+                    'version': release['tag_name'],
+                    'published_at': release.get('published_at'),
+                    'download_url': asset['browser_download_url'],
+                    'size': asset['size'],
+                    'release_notes': release.get('body', ''),
+                    'prerelease': release.get('prerelease', False)
+                }
+        return None
+
+    def _fetch_releases(self, refresh=False):
+        """Release list (newest first) from the persisted per-repo catalog."""
+        return self.release_catalog.releases(refresh)
+
     def get_latest_release_info(self):
-        """Get latest release information from GitHub API."""
+        """Latest release, derived from the release list (same rule as /releases/latest)."""
         if self.repo_owner in ["your_github_username"] and self.repo_name == "your_github_repository":
             return None, "Repository configuration not set"
-        
-        api_url = f"https://api.github.com/repos/{self.repo_owner}/{self.repo_name}/releases/latest"
-        
+
         try:
-            response = requests.get(api_url, timeout=15)
-            response.raise_for_status()
-            release_data = response.json()
-            
-            # Find the firmware asset
-            asset_url = None
-            asset_size = None
-            for asset in release_data.get('assets', []):
-                if asset['name'] == self.asset_name:
-                    asset_url = asset['browser_download_url']
-                    asset_size = asset['size']
-                    break
-            
-            if not asset_url:
+            latest = next((r for r in self._fetch_releases() if not r.get('draft') and not r.get('prerelease')), None)
+            if not latest:
+                return None, "No published releases"
+            release_info = self._release_entry(latest)
+            if not release_info:
                 return None, f"Firmware asset '{self.asset_name}' not found in latest release"
-            
-            return {
-                'version': release_data['tag_name'],
-                'published_at': release_data['published_at'],
-                'download_url': asset_url,
-                'size': asset_size,
-                'release_notes': release_data.get('body', ''),
-                'prerelease': release_data.get('prerelease', False)
-            }, None
-            
+            return release_info, None
+        except GitHubRateLimited as e:
+            return None, str(e)
         except requests.exceptions.RequestException as e:
             return None, f"Network error: {e}"
         except Exception as e:
             return None, f"Unexpected error: {e}"
-    
+
     def get_all_releases_info(self):
         """Get all releases information from GitHub API."""
         if self.repo_owner in ["your_github_username"] and self.repo_name == "your_github_repository":
             return None, "Repository config not set"
-        
-        api_url = f"https://api.github.com/repos/{self.repo_owner}/{self.repo_name}/releases"
+
         try:
-            response = requests.get(api_url, timeout=15)
-            response.raise_for_status()
-            releases_data = response.json()
-            
-            releases = []
-            for release in releases_data:
-                tag_name = release.get('tag_name')
-                asset_url = None
-                asset_size = None
-                for asset in release.get('assets', []):
-                    if asset['name'] == self.asset_name:
-                        asset_url = asset['browser_download_url']
-                        asset_size = asset['size']
-                        break
-                if asset_url:
-                    releases.append({
-                        'version': tag_name,
-                        'published_at': release.get('published_at'),
-                        'download_url': asset_url,
-                        'size': asset_size,
-                        'release_notes': release.get('body', ''),
-                        'prerelease': release.get('prerelease', False)
-                    })
-            return releases, None
+            releases = [self._release_entry(release) for release in self._fetch_releases()]
+            return [release for release in releases if release], None
         except Exception as e:
             return None, f"Error: {e}"
 
-    def needs_update(self):
+    def needs_update(self, force=False):
         """Check if firmware needs updating."""
         # Skip if we've checked recently
         current_time = time.time()
-        if current_time - self.last_check_time < self.check_interval:
+        if not force and current_time - self.last_check_time < self.check_interval:
             return False, "Recently checked", None
         
         release_info, error = self.get_latest_release_info()
@@ -232,6 +915,7 @@ class FirmwareManager:
         
         # Update last check time
         self.last_check_time = current_time
+        firmware_catalog.invalidate(self.bot_name)
         
         # If no local firmware exists, we need to download
         if not os.path.exists(self.firmware_path):
@@ -247,13 +931,9 @@ class FirmwareManager:
         
         return False, "Up to date", release_info
     
-    def download_firmware(self, release_info=None):
-        """Download firmware with version tracking."""
-        with firmware_lock:
-            if self.is_checking:
-                return False, "Download already in progress"
-            self.is_checking = True
-        
+    def download_firmware(self, release_info=None, progress=None, cancel=None):
+        """Download firmware with version tracking. Runs on the bot's job worker
+        (firmware_jobs), which serializes downloads and activations per bot."""
         try:
             versions_dir = os.path.join(self.static_dir, 'versions')
             os.makedirs(versions_dir, exist_ok=True)
@@ -262,61 +942,22 @@ class FirmwareManager:
                 
             v_name = release_info['version']
             target_bin = os.path.join(versions_dir, f"{v_name}.bin")
-            
+
             # Download the specific release if we don't have it fully cached offline
-            if not (os.path.exists(target_bin) and os.path.getsize(target_bin) == release_info.get('size', -1)):
-                print(f"🚀 Downloading firmware version {v_name} into cache...")
-                try:
-                    response = requests.get(release_info['download_url'], stream=True, timeout=60)
-                    response.raise_for_status()
-                    
-                    downloaded_size = 0
-                    with open(target_bin + '.tmp', 'wb') as f:
-                        for chunk in response.iter_content(chunk_size=8192):
-                            if chunk:
-                                f.write(chunk)
-                                downloaded_size += len(chunk)
-                                
-                    if downloaded_size == release_info.get('size', downloaded_size):
-                        os.rename(target_bin + '.tmp', target_bin)
-                    else:
-                        os.unlink(target_bin + '.tmp')
-                        return False, f"Incomplete download for {v_name}"
-                        
-                except Exception as e:
-                    return False, f"Failed to download {v_name}: {e}"
-            else:
-                print(f"⚡ Using offline cached version {v_name} for activation...")
-            
+            ok, message = self.fetch_release(release_info, progress=progress, cancel=cancel)
+            if not ok:
+                return False, message
+
             if os.path.exists(target_bin):
-                import shutil
-                shutil.copy2(target_bin, self.firmware_path)
-                
-                # Calculate hash for integrity
-                file_hash = self._get_file_hash(self.firmware_path)
-                
-                # Update metadata
-                metadata = {
-                    'version': release_info['version'],
-                    'downloaded_at': datetime.now().isoformat(),
-                    'last_check': time.time(),
-                    'size': release_info.get('size', os.path.getsize(self.firmware_path)),
-                    'hash': file_hash,
-                    'release_notes': release_info.get('release_notes', ''),
-                    'prerelease': release_info.get('prerelease', False),
-                    'published_at': release_info.get('published_at', '')
-                }
-                self._save_metadata(metadata)
-                
+                # Digests were computed while downloading (sidecar files next to the .bin)
+                metadata = self._release_metadata(release_info, file_digests(target_bin), os.path.getsize(target_bin))
+
                 # ALSO cache this metadata permanently for offline swaps!
-                with open(os.path.join(versions_dir, f"{release_info['version']}.json"), 'w') as mf:
-                    json.dump(metadata, mf, indent=2)
-                
-                self.current_version = release_info['version']
+                _write_json_atomic(os.path.join(versions_dir, f"{release_info['version']}.json"), metadata)
 
-                # Regenerate manifest so the flasher always uses the correct binary + version
-                self._generate_manifest(self.current_version)
-                
+                if progress:
+                    progress('activating')
+                self.activate(v_name, metadata, source='github')
                 msg = f"Activated latest firmware version {release_info['version']}."
                 return True, msg
             else:
@@ -324,20 +965,158 @@ class FirmwareManager:
                 
         except Exception as e:
             return False, f"Download failed: {e}"
-        finally:
-            with firmware_lock:
-                self.is_checking = False
+
+    def activate_cached(self, version):
+        """Offline swap to versions/<version>.bin; (False, message) if it isn't cached."""
+        versions_dir = os.path.join(self.static_dir, 'versions')
+        bin_path = os.path.join(versions_dir, f"{version}.bin")
+        if not os.path.exists(bin_path):
+            return False, f"{version} is not cached"
+        digests = file_digests(bin_path)
+
+        # Restore complete cached metadata if available
+        cached_meta_path = os.path.join(versions_dir, f"{version}.json")
+        if os.path.exists(cached_meta_path):
+            with open(cached_meta_path, 'r') as mf:
+                m = json.load(mf)
+        else:
+            release = self.release_catalog.find(version)
+            release_info = self._release_entry(release) if release else None
+            if release_info:
+                m = self._release_metadata(release_info, digests, os.path.getsize(bin_path))
+            else:
+                m = {'version': version, 'last_check': self.last_check_time,
+                     'size': os.path.getsize(bin_path),
+                     'release_notes': "Offline swapped (no cached notes)"}
+        m.update(hash=digests['sha256'], md5=digests['md5'])
+        self.activate(version, m, source='offline')
+        return True, f'Swapped instantly to local cached version: {version}'
     
-    # Background checker method removed
+    def activate(self, version, metadata, source):
+        """Point the served asset at versions/<version>.bin and flip metadata and in-memory
+        state (which the manifest is rendered from) with it under the bot's lock. The asset is swapped with os.replace
+        of a hardlink (symlink where hardlinks aren't supported), so it is O(1) and a
+        station fetching it mid-swap sees either the old or the new image, never a mix."""
+        target_bin = os.path.join(self.static_dir, 'versions', f"{version}.bin")
+        with self.lock:
+            _link_into_place(target_bin, self.firmware_path)
+            firmware_store.add(self.bot_name, 'asset', self.asset_name, self.firmware_path, metadata.get('hash'))
+            self._save_metadata(metadata)
+            self.current_version = version
+            self.current_hash = metadata.get('hash')
+            self.current_md5 = metadata.get('md5')
+        firmware_catalog.invalidate(self.bot_name)
+        firmware_store.touch(self.bot_name, version)
+        audit_log.record('firmware_activate', bot=self.bot_name, firmware_version=version,
+                         firmware_sha256=self.current_hash, source=source)
+
+    def _release_metadata(self, release_info, digests, size):
+        return {
+            'version': release_info['version'],
+            'downloaded_at': datetime.now().isoformat(),
+            'last_check': time.time(),
+            'size': release_info.get('size', size),
+            'hash': digests['sha256'],
+            'md5': digests['md5'],
+            'release_notes': release_info.get('release_notes', ''),
+            'prerelease': release_info.get('prerelease', False),
+            'published_at': release_info.get('published_at', '')
+        }
+
+    def fetch_release(self, release_info, max_bytes_per_sec=None, progress=None, cancel=None):
+        """Make sure versions/<v>.bin holds the complete release asset.
+
+        A partial versions/<v>.bin.tmp left by an interrupted (or cancelled) transfer is
+        resumed with an HTTP Range request and kept on failure, so a flaky link never
+        restarts from zero. Already-cached versions are a no-op, which makes repeated calls
+        safe. `progress(stage, done, total)` is called as bytes arrive; setting `cancel`
+        stops the transfer.
+        """
+        versions_dir = os.path.join(self.static_dir, 'versions')
+        os.makedirs(versions_dir, exist_ok=True)
+        v_name = release_info['version']
+        target_bin = os.path.join(versions_dir, f"{v_name}.bin")
+        tmp_path = target_bin + '.tmp'
+        expected = release_info.get('size')
+
+        # The thread lock orders this process; the flock keeps another process off the same .tmp
+        with _download_lock(target_bin), _process_file_lock(tmp_path + '.lock'):
+            if os.path.exists(target_bin) and os.path.getsize(target_bin) == expected:
+                print(f"⚡ Using offline cached version {v_name}")
+                return True, f"{v_name} already cached"
+            have = os.path.getsize(tmp_path) if os.path.exists(tmp_path) else 0
+            if expected is not None and have > expected:
+                os.unlink(tmp_path)
+                have = 0
+            # Digests are computed in the write loop; a resumed transfer first feeds in the partial prefix
+            if have and progress:
+                progress('hashing', have, expected)
+            sha256, md5 = _hash_file(tmp_path) if have else (hashlib.sha256(), hashlib.md5())
+            if expected is None or have < expected:
+                headers = {'Accept': 'application/octet-stream'}
+                if have:
+                    headers['Range'] = f'bytes={have}-'
+                print(f"🚀 Downloading firmware version {v_name} into cache" + (f" (resuming at {have} bytes)..." if have else "..."))
+                received = 0
+                try:
+                    with github.session.get(release_info['download_url'], stream=True, timeout=60, headers=headers) as response:
+                        response.raise_for_status()
+                        if response.status_code != 206:
+                            have = 0  # server ignored the Range header; start over
+                            sha256, md5 = hashlib.sha256(), hashlib.md5()
+                        started = time.monotonic()
+                        with open(tmp_path, 'ab' if have else 'wb') as f:
+                            for chunk in response.iter_content(chunk_size=64 * 1024):
+                                if chunk:
+                                    f.write(chunk)
+                                    sha256.update(chunk)
+                                    md5.update(chunk)
+                                    received += len(chunk)
+                                    if progress:
+                                        progress('downloading', have + received, expected)
+                                    if cancel is not None and cancel.is_set():
+                                        return False, f"Download of {v_name} cancelled"  # partial kept for resume
+                                    if max_bytes_per_sec:
+                                        ahead = received / max_bytes_per_sec - (time.monotonic() - started)
+                                        if ahead > 0:
+                                            time.sleep(ahead)
+                    have += received
+                except Exception as e:
+                    return False, f"Failed to download {v_name}: {e}"
+
+            if expected is not None and have != expected:
+                if have > expected:
+                    os.unlink(tmp_path)
+                return False, f"Incomplete download for {v_name} ({have}/{expected} bytes)"
+            os.replace(tmp_path, target_bin)
+            write_digests(target_bin, sha256.hexdigest(), md5.hexdigest())
+            firmware_store.add(self.bot_name, 'version', v_name, target_bin, sha256.hexdigest())
+        firmware_store.enforce_quota(keep={(self.bot_name, v_name)})
+        return True, f"Downloaded {v_name}"
+
+    def cache_release_metadata(self, release_info):
+        """Write versions/<v>.json for an offline swap, if it isn't there yet."""
+        versions_dir = os.path.join(self.static_dir, 'versions')
+        meta_path = os.path.join(versions_dir, f"{release_info['version']}.json")
+        target_bin = os.path.join(versions_dir, f"{release_info['version']}.bin")
+        if os.path.exists(meta_path) or not os.path.exists(target_bin):
+            return
+        metadata = self._release_metadata(release_info, file_digests(target_bin), os.path.getsize(target_bin))
+        with open(meta_path + '.tmp', 'w') as mf:
+            json.dump(metadata, mf, indent=2)
+        os.replace(meta_path + '.tmp', meta_path)
+        firmware_catalog.invalidate(self.bot_name)
 
     
     def get_status(self):
-        """Get current firmware status."""
+        """Build the firmware status from disk; requests get it through firmware_catalog."""
         status = {
             'local_firmware_exists': os.path.exists(self.firmware_path),
             'current_version': self.current_version,
             'last_check': self.last_check_time,
-            'is_checking': self.is_checking,
+            'is_checking': firmware_jobs.active(self.bot_name) is not None,
+            'sha256': self.current_hash,
+            'md5': self.current_md5,
             'repo': f"{self.repo_owner}/{self.repo_name}",
             'asset_name': self.asset_name
         }
@@ -347,17 +1126,52 @@ class FirmwareManager:
             status['file_size'] = stat.st_size
             status['file_modified'] = stat.st_mtime
             
-        # Append locally downloaded versions for offline swapping
+        # Append locally downloaded versions for offline swapping, newest first
         versions_dir = os.path.join(self.static_dir, 'versions')
-        offline_versions = []
+        pinned = firmware_store.pinned(self.bot_name)
+        versions = []
         if os.path.exists(versions_dir):
             for f in os.listdir(versions_dir):
                 if f.endswith('.bin'):
-                    offline_versions.append(f.replace('.bin', ''))
-        status['offline_versions'] = sorted(offline_versions, reverse=True)
+                    versions.append(self._version_entry(versions_dir, f[:-len('.bin')], pinned))
+        versions.sort(key=lambda v: version_key(v['version']), reverse=True)
+        status['offline_versions'] = [v['version'] for v in versions]
+        status['versions'] = versions
+        status['pinned_versions'] = pinned
+        status['store'] = firmware_store.stats()
         
         return status
 
+    def _version_entry(self, versions_dir, version, pinned):
+        """Size, digests and cached release metadata of one versions/<v>.bin."""
+        bin_path = os.path.join(versions_dir, f"{version}.bin")
+        entry = {'version': version, 'size': os.path.getsize(bin_path), 'active': version == self.current_version,
+                 'pinned': version in pinned}
+        entry.update(read_digests(bin_path) or {})
+        try:
+            with open(os.path.join(versions_dir, f"{version}.json")) as f:
+                meta = json.load(f)
+            entry.update({k: meta[k] for k in ('published_at', 'prerelease', 'release_notes', 'downloaded_at') if k in meta})
+        except (OSError, ValueError):
+            pass
+        return entry
+
+    def adopt_into_store(self):
+        """Index (and dedup) the cached versions, the served asset and the boot files."""
+        firmware_store.prune(self.bot_name)
+        versions_dir = os.path.join(self.static_dir, 'versions')
+        if os.path.isdir(versions_dir):
+            for f in os.listdir(versions_dir):
+                if f.endswith('.bin'):
+                    firmware_store.adopt(self.bot_name, 'version', f[:-len('.bin')], os.path.join(versions_dir, f))
+        if os.path.exists(self.firmware_path):
+            firmware_store.adopt(self.bot_name, 'asset', self.asset_name, self.firmware_path)
+        for url in self.boot_files():
+            path = os.path.join(os.path.dirname(self.static_dir), url[len('/static/'):])
+            if os.path.exists(path):
+                # Boot files are shared between bots, so they are keyed by path, not by bot
+                firmware_store.adopt('static', 'boot', url, path)
+
 def initialize_firmware_managers():
     """Initialize the global firmware managers."""
     global firmware_managers
@@ -372,117 +1186,569 @@ def initialize_firmware_managers():
         # Perform initial firmware check (Local only)
         print(f"🔍 Initialized firmware manager for {bot_name} (Current: {firmware_managers[bot_name].current_version})")
 
+    for manager in firmware_managers.values():
+        try:
+            manager.adopt_into_store()
+        except Exception as e:
+            print(f"⚠️  Warning: Could not index {manager.bot_name} firmware into the store: {e}")
+    firmware_store.enforce_quota()
+    stats = firmware_store.stats()
+    print(f"📦 Firmware store: {stats['usage_bytes'] // 1024} KB on disk, {stats['dedup_saved_bytes'] // 1024} KB saved by dedup")
+
+# ---------- Firmware Catalog ----------
+
+# Status of every bot, built from disk once and kept as serialized JSON until activation,
+# a download, a check or a store change invalidates it. A status poll is a dict lookup
+# (or a 304), never a stat/listdir of versions/.
+class FirmwareCatalog:
+    def __init__(self):
+        self._entries = {}      # bot -> (status, body, etag)
+        self._generation = {}   # bot -> bumped by invalidate(); guards against racing rebuilds
+        self._combined = None
+        self._lock = Lock()
+
+    def invalidate(self, bot_name=None):
+        """Drop one bot's entry, or all of them (store-wide changes)."""
+        with self._lock:
+            for bot in [bot_name] if bot_name else list(firmware_managers):
+                self._generation[bot] = self._generation.get(bot, 0) + 1
+                self._entries.pop(bot, None)
+            self._combined = None
+
+    def _entry(self, bot_name):
+        """(status, json bytes, etag) for one bot, rebuilt only after an invalidation."""
+        with self._lock:
+            entry = self._entries.get(bot_name)
+            generation = self._generation.get(bot_name, 0)
+        if entry:
+            return entry
+        status = firmware_managers[bot_name].get_status()
+        body = json.dumps(status, sort_keys=True).encode()
+        entry = (status, body, hashlib.sha256(body).hexdigest())
+        with self._lock:
+            if self._generation.get(bot_name, 0) == generation:
+                self._entries[bot_name] = entry
+        return entry
+
+    def get(self, bot_name):
+        """(json bytes, etag) of one bot's status."""
+        return self._entry(bot_name)[1:]
+
+    def get_all(self):
+        """(json bytes, etag) of every bot's status in one payload."""
+        with self._lock:
+            combined = self._combined
+        if combined:
+            return combined
+        entries = {bot: self._entry(bot) for bot in list(firmware_managers)}
+        body = json.dumps({'bots': {bot: entry[0] for bot, entry in entries.items()}}, sort_keys=True).encode()
+        combined = (body, hashlib.sha256(body).hexdigest())
+        with self._lock:
+            if all(self._entries.get(bot) is entry for bot, entry in entries.items()):
+                self._combined = combined
+        return combined
+
+firmware_catalog = FirmwareCatalog()
+
+# ---------- Firmware Jobs ----------
+
+# Downloads and activations run on one worker thread per bot, fed by a queue, so a request
+# only enqueues and returns a job id. Jobs for the same bot run in submission order, which
+# replaces the old is_checking flag; an identical job still queued or running is reused.
+FIRMWARE_JOBS_KEPT = 50  # finished jobs kept for status/replay
+JOB_FINISHED_STATES = ('done', 'failed', 'cancelled')
+
+class FirmwareJob:
+    def __init__(self, bot_name, version):
+        self.id = secrets.token_hex(8)
+        self.bot_name = bot_name
+        self.version = version
+        self.state = 'queued'
+        self.stage = 'queued'   # resolving, hashing, downloading, activating
+        self.done_bytes = 0
+        self.total_bytes = None
+        self.rate = None        # bytes/s over the current stage
+        self.eta = None         # seconds
+        self.message = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel = Event()
+        self.seq = 0
+        self._changed = Condition()
+        self._last_notify = 0
+        self._rate_mark = None
+
+    @property
+    def finished(self):
+        return self.state in JOB_FINISHED_STATES
+
+    def _notify(self):
+        with self._changed:
+            self.seq += 1
+            self._changed.notify_all()
+
+    def progress(self, stage, done=None, total=None):
+        """Progress callback for fetch_release/download_firmware; throttled to ~4 events/s."""
+        now = time.monotonic()
+        if done is not None:
+            if self._rate_mark is None or stage != self.stage:
+                self._rate_mark = (now, done)
+            self.done_bytes, self.total_bytes = done, total
+            mark_time, mark_bytes = self._rate_mark
+            if now - mark_time >= 0.5:
+                self.rate = (done - mark_bytes) / (now - mark_time)
+                self.eta = (total - done) / self.rate if total and self.rate else None
+        if stage == self.stage and now - self._last_notify < 0.25:
+            return
+        self.stage = stage
+        self._last_notify = now
+        self._notify()
+
+    def start(self):
+        self.state = self.stage = 'running'
+        self.started_at = time.time()
+        self._notify()
+
+    def finish(self, state, message=None):
+        self.state = state
+        self.stage = state
+        self.message = message
+        self.eta = None
+        self.finished_at = time.time()
+        self._notify()
+
+    def wait(self, seen, timeout):
+        """Block until the job changes past `seen` (or timeout); returns the current seq."""
+        with self._changed:
+            self._changed.wait_for(lambda: self.seq != seen, timeout)
+            return self.seq
+
+    def snapshot(self):
+        return {'id': self.id, 'bot': self.bot_name, 'version': self.version, 'state': self.state,
+                'stage': self.stage, 'done_bytes': self.done_bytes, 'total_bytes': self.total_bytes,
+                'rate': round(self.rate) if self.rate else None, 'eta': round(self.eta, 1) if self.eta else None,
+                'message': self.message, 'created_at': self.created_at, 'started_at': self.started_at,
+                'finished_at': self.finished_at}
+
+class FirmwareJobs:
+    def __init__(self, keep=FIRMWARE_JOBS_KEPT):
+        self.keep = keep
+        self.jobs = OrderedDict()  # id -> FirmwareJob, oldest first
+        self._queues = {}          # bot -> queue.Queue, each drained by its own worker thread
+        self._lock = Lock()
+
+    def submit(self, bot_name, version=None):
+        """(job, created): the queued/running job for the same bot and version, or a new one."""
+        with self._lock:
+            for job in self.jobs.values():
+                if job.bot_name == bot_name and job.version == version and not job.finished and not job.cancel.is_set():
+                    return job, False
+            job = FirmwareJob(bot_name, version)
+            self.jobs[job.id] = job
+            finished = [j for j in self.jobs.values() if j.finished]
+            for old in finished[:max(len(finished) - self.keep, 0)]:
+                del self.jobs[old.id]
+            jobs_queue = self._queues.get(bot_name)
+            if jobs_queue is None:
+                jobs_queue = self._queues[bot_name] = queue.Queue()
+                Thread(target=self._worker, args=(jobs_queue,), name=f'fw-jobs-{bot_name}', daemon=True).start()
+        jobs_queue.put(job)
+        firmware_catalog.invalidate(bot_name)
+        return job, True
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def list(self, bot_name=None):
+        with self._lock:
+            return [job for job in reversed(self.jobs.values()) if bot_name in (None, job.bot_name)]
+
+    def active(self, bot_name):
+        """The bot's running or queued job, if any."""
+        with self._lock:
+            return next((job for job in self.jobs.values() if job.bot_name == bot_name and not job.finished), None)
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.finished:
+                return job
+            job.cancel.set()
+            if job.state == 'queued':
+                job.finish('cancelled', 'Cancelled before it started')
+        firmware_catalog.invalidate(job.bot_name)
+        return job
+
+    def _worker(self, jobs_queue):
+        while True:
+            job = jobs_queue.get()
+            if job.finished:
+                continue  # cancelled while queued
+            job.start()
+            try:
+                ok, message = self._run(firmware_managers[job.bot_name], job)
+            except Exception as e:
+                ok, message = False, str(e)
+            if not ok and job.cancel.is_set():
+                job.finish('cancelled', message)
+            else:
+                job.finish('done' if ok else 'failed', message)
+            firmware_catalog.invalidate(job.bot_name)
+
+    def _run(self, manager, job):
+        job.progress('resolving')
+        # An offline swap never touches GitHub (no rate limits, instant)
+        if job.version:
+            ok, message = manager.activate_cached(job.version)
+            if ok:
+                return ok, message
+            all_releases, error = manager.get_all_releases_info()
+            release_info = next((r for r in all_releases or [] if r['version'] == job.version), None)
+            if not release_info:
+                return False, error or f'Version {job.version} not found in releases or offline cache'
+        else:
+            release_info, error = manager.get_latest_release_info()
+            if error:
+                return False, error
+        return manager.download_firmware(release_info, progress=job.progress, cancel=job.cancel)
+
+firmware_jobs = FirmwareJobs()
+
+# ---------- Firmware Prefetch ----------
+
+# Keeps the newest releases of every bot in versions/ so activation on the floor is an
+# offline swap. Runs in one low-priority thread with a bandwidth cap, jittered intervals
+# and per-bot exponential back-off.
+PREFETCH_RELEASES = int(os.environ.get('PREFETCH_RELEASES', 3))
+PREFETCH_MAX_BYTES_PER_SEC = int(os.environ.get('PREFETCH_MAX_BYTES_PER_SEC', 256 * 1024))
+PREFETCH_INTERVAL = 6 * 3600
+PREFETCH_BACKOFF_BASE = 60
+PREFETCH_BACKOFF_MAX = 3600
+
+class FirmwarePrefetcher:
+    def __init__(self, keep=PREFETCH_RELEASES, max_bytes_per_sec=PREFETCH_MAX_BYTES_PER_SEC):
+        self.keep = keep
+        self.max_bytes_per_sec = max_bytes_per_sec
+        self.state = {}  # bot -> {'failures', 'next_attempt', 'last_error', 'cached', 'last_run'}
+        self._wake = Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None and self.keep > 0:
+            self._thread = Thread(target=self._run, name='firmware-prefetch', daemon=True)
+            self._thread.start()
+
+    def trigger(self):
+        """Run a pass now for every bot (skipping back-off)."""
+        for state in self.state.values():
+            state['next_attempt'] = 0
+        self._wake.set()
+
+    def _run(self):
+        try:
+            os.setpriority(os.PRIO_PROCESS, get_native_id(), 10)  # Linux: per-thread nice
+        except (AttributeError, OSError):
+            pass
+        self._wake.wait(random.uniform(10, 60))  # stay out of the way during startup
+        while True:
+            self._wake.clear()
+            for bot_name, manager in list(firmware_managers.items()):
+                state = self.state.setdefault(bot_name, {'failures': 0, 'next_attempt': 0})
+                if time.time() >= state['next_attempt']:
+                    self._prefetch_bot(manager, state)
+            next_attempt = min((s['next_attempt'] for s in self.state.values()), default=time.time() + PREFETCH_INTERVAL)
+            self._wake.wait(max(next_attempt - time.time(), 1))
+
+    def _prefetch_bot(self, manager, state):
+        state['last_run'] = time.time()
+        try:
+            releases, error = manager.get_all_releases_info()
+            if error:
+                raise RuntimeError(error)
+            cached = []
+            for release in releases[:self.keep]:
+                ok, message = manager.fetch_release(release, self.max_bytes_per_sec)
+                if not ok:
+                    raise RuntimeError(message)
+                manager.cache_release_metadata(release)
+                cached.append(release['version'])
+            if detools is not None and cached:
+                self._prefetch_deltas(manager, cached[0])
+                firmware_store.enforce_quota()
+            state.update(failures=0, last_error=None, cached=cached,
+                         next_attempt=time.time() + PREFETCH_INTERVAL * random.uniform(0.9, 1.1))
+        except Exception as e:
+            state['failures'] += 1
+            delay = min(PREFETCH_BACKOFF_BASE * 2 ** state['failures'], PREFETCH_BACKOFF_MAX) * random.uniform(0.5, 1.0)
+            if github.status()['rate_limited']:
+                delay = max(delay, github.rate_limit['reset'] - time.time())
+            state.update(last_error=str(e), next_attempt=time.time() + delay)
+            print(f"⚠️  Prefetch for {manager.bot_name} failed ({e}); retrying in {int(delay)}s")
+
+    def _prefetch_deltas(self, manager, newest):
+        """Build deltas from every other cached version to the newest release, so BLE updates
+        of robots still on an older build are served straight from the cache."""
+        to_sha256 = firmware_store.version_sha256(manager.bot_name, newest)
+        versions_dir = os.path.join(manager.static_dir, 'versions')
+        for f in sorted(os.listdir(versions_dir)):
+            from_sha256 = firmware_store.version_sha256(manager.bot_name, f[:-len('.bin')]) if f.endswith('.bin') else None
+            if from_sha256 and to_sha256 and from_sha256 != to_sha256:
+                try:
+                    firmware_store.delta(from_sha256, to_sha256)
+                except Exception as e:
+                    print(f"⚠️  Delta {manager.bot_name} {f[:-len('.bin')]} → {newest} failed: {e}")
+
+    def status(self):
+        return {'running': self._thread is not None, 'keep': self.keep,
+                'max_bytes_per_sec': self.max_bytes_per_sec, 'bots': self.state}
+
+firmware_prefetcher = FirmwarePrefetcher()
+
 # ---------- New Firmware API Routes ----------
 
+@app.route('/static/<bot_name>/manifest.json')
+def firmware_manifest(bot_name):
+    """esp-web-tools manifest of the active firmware, rendered from memory (ETag/304).
+    Takes precedence over the static file route, so existing flasher URLs keep working."""
+    if bot_name not in firmware_managers:
+        return jsonify({'error': f'Invalid bot name: {bot_name}'}), 404
+    body, etag = firmware_managers[bot_name].manifest()
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype='application/json', headers=headers)
+
+def _catalog_response(body, etag):
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype='application/json', headers=headers)
+
 @app.route('/api/firmware/<bot_name>/status')
 def firmware_status(bot_name):
-    """Get current firmware status."""
+    """Get current firmware status (from the catalog; ETag/304)."""
     try:
         if bot_name not in firmware_managers:
             return jsonify({'error': f'Invalid bot name: {bot_name}'}), 404
-        
-        status = firmware_managers[bot_name].get_status()
-        return jsonify(status)
+
+        return _catalog_response(*firmware_catalog.get(bot_name))
     except Exception as e:
         return jsonify({'error': f'Status check failed: {str(e)}'}), 500
 
+@app.route('/api/firmware/status')
+def firmware_status_all():
+    """Status of every bot in one payload (from the catalog; ETag/304)."""
+    try:
+        return _catalog_response(*firmware_catalog.get_all())
+    except Exception as e:
+        return jsonify({'error': f'Status check failed: {str(e)}'}), 500
+
+FIRMWARE_CHECK_WORKERS = min(len(FIRMWARE_REPOS), 8)
+FIRMWARE_CHECK_TIMEOUT = 20  # seconds for the whole check-all fan-out
+_firmware_check_pool = ThreadPoolExecutor(max_workers=FIRMWARE_CHECK_WORKERS, thread_name_prefix='fw-check')
+
+def _check_update_payload(manager, deadline=None):
+    """needs_update() plus the release list, shaped for the UI. With a `deadline` (time.time())
+    the GitHub refresh gets only the time that is left as its request timeout."""
+    # A manual check always asks GitHub for new releases (a single 304 when nothing changed);
+    # concurrent checks of the same repo share that one request
+    try:
+        timeout = 15 if deadline is None else max(deadline - time.time(), 0.1)
+        manager.release_catalog.releases(refresh=True, timeout=timeout)
+    except Exception:
+        pass  # reported by needs_update() below
+
+    # Forced rather than resetting last_check_time, which raced between concurrent checks
+    needs_update, reason, release_info = manager.needs_update(force=True)
+
+    # Fetch all available releases to show dropdown
+    all_releases, error = manager.get_all_releases_info()
+
+    result = {
+        'needs_update': needs_update,
+        'reason': reason,
+        'current_version': manager.current_version,
+        'available_versions': all_releases if all_releases else []
+    }
+
+    if release_info:
+        result['latest_version'] = release_info['version']
+        result['release_notes'] = release_info['release_notes']
+        result['published_at'] = release_info['published_at']
+        result['prerelease'] = release_info['prerelease']
+    elif error:
+        result['error'] = error
+    return result
+
 @app.route('/api/firmware/<bot_name>/check-update', methods=['POST'])
 def check_firmware_update(bot_name):
     """Manually trigger firmware update check."""
     try:
         if bot_name not in firmware_managers:
             return jsonify({'error': f'Invalid bot name: {bot_name}'}), 404
-        
-        manager = firmware_managers[bot_name]
-        # Force check by resetting last check time
-        manager.last_check_time = 0
-        
-        needs_update, reason, release_info = manager.needs_update()
-        
-        # Fetch all available releases to show dropdown
-        all_releases, error = manager.get_all_releases_info()
-        
-        result = {
-            'needs_update': needs_update,
-            'reason': reason,
-            'current_version': manager.current_version,
-            'available_versions': all_releases if all_releases else []
-        }
-        
-        if release_info:
-            result['latest_version'] = release_info['version']
-            result['release_notes'] = release_info['release_notes']
-            result['published_at'] = release_info['published_at']
-            result['prerelease'] = release_info['prerelease']
-        
-        return jsonify(result)
-        
+
+        return jsonify(_check_update_payload(firmware_managers[bot_name]))
+
     except Exception as e:
         return jsonify({'error': f'Update check failed: {str(e)}'}), 500
 
+@app.route('/api/firmware/check-all', methods=['POST'])
+def check_all_firmware_updates():
+    """Check every bot concurrently; bots that fail or run out of time are reported, not fatal."""
+    try:
+        timeout = min(float(request.args.get('timeout', FIRMWARE_CHECK_TIMEOUT)), FIRMWARE_CHECK_TIMEOUT)
+    except ValueError:
+        return jsonify({'error': 'timeout must be a number'}), 400
+
+    started = time.time()
+    futures = {_firmware_check_pool.submit(_check_update_payload, manager, started + timeout): bot_name
+               for bot_name, manager in firmware_managers.items()}
+    done, not_done = wait(futures, timeout=timeout)
+    for future in not_done:
+        future.cancel()  # still queued: don't let it hold a worker for the next check-all
+
+    results = {}
+    for future, bot_name in futures.items():
+        if future in not_done:
+            results[bot_name] = {'error': f'Timed out after {timeout:g}s'}
+        elif future.exception():
+            results[bot_name] = {'error': f'Update check failed: {future.exception()}'}
+        else:
+            results[bot_name] = future.result()
+    return jsonify({
+        'bots': results,
+        'partial': any('error' in result for result in results.values()),
+        'updates_available': sorted(bot for bot, result in results.items() if result.get('needs_update')),
+        'elapsed': round(time.time() - started, 3),
+        'github': github.status()['rate_limit']
+    })
+
 @app.route('/api/firmware/<bot_name>/download', methods=['POST'])
 def download_firmware(bot_name):
-    """Manually trigger firmware download."""
+    """Queue a download/activation job and return its id right away (202).
+    Progress streams from /api/firmware/jobs/<id>/events."""
     try:
         if bot_name not in firmware_managers:
             return jsonify({'error': f'Invalid bot name: {bot_name}'}), 404
-            
-        manager = firmware_managers[bot_name]
-        if manager.is_checking:
-            return jsonify({'error': 'Download already in progress'}), 409
-        
-        # Check if caller wants a specific version
-        data = request.json or {}
-        target_version = data.get('version')
-        
-        # If offline swap available, do it INSTANTLY without touching GitHub to prevent rate limits
-        versions_dir = os.path.join(manager.static_dir, 'versions')
-        offline_target_path = os.path.join(versions_dir, f"{target_version}.bin") if target_version else None
-        
-        if offline_target_path and os.path.exists(offline_target_path):
-            import shutil
-            shutil.copy2(offline_target_path, manager.firmware_path)
-            
-            # Restore complete cached metadata if available
-            cached_meta_path = os.path.join(versions_dir, f"{target_version}.json")
-            if os.path.exists(cached_meta_path):
-                with open(cached_meta_path, 'r') as mf:
-                    m = json.load(mf)
-                manager._save_metadata(m)
-            else:
-                m = manager._load_metadata()
-                m['version'] = target_version
-                m['size'] = os.path.getsize(manager.firmware_path)
-                m['hash'] = manager._get_file_hash(manager.firmware_path)
-                m['release_notes'] = "Offline swapped (no cached notes)"
-                manager._save_metadata(m)
-                
-            manager.current_version = target_version
-            manager._generate_manifest(target_version)
 
-            return jsonify({'success': True, 'message': f'Swapped instantly to local cached version: {target_version}'})
-            
-        release_info = None
-        if target_version:
-            all_releases, _ = manager.get_all_releases_info()
-            if all_releases:
-                for r in all_releases:
-                    if r['version'] == target_version:
-                        release_info = r
-                        break
-            if not release_info:
-                return jsonify({'error': f'Version {target_version} not found in releases or offline cache'}), 404
-        
-        success, message = manager.download_firmware(release_info)
-        
-        if success:
-            return jsonify({'success': True, 'message': message})
-        else:
-            return jsonify({'success': False, 'error': message}), 500
-            
+        # Check if caller wants a specific version (default: latest release)
+        data = request.get_json(silent=True) or {}
+        job, created = firmware_jobs.submit(bot_name, data.get('version') or None)
+        return jsonify({'success': True, 'job_id': job.id, 'deduplicated': not created,
+                        'events': f'/api/firmware/jobs/{job.id}/events', 'job': job.snapshot()}), 202
     except Exception as e:
         return jsonify({'error': f'Download failed: {str(e)}'}), 500
 
+@app.route('/api/firmware/jobs')
+def firmware_job_list():
+    """Recent jobs, newest first (?bot= to filter)."""
+    return jsonify({'jobs': [job.snapshot() for job in firmware_jobs.list(request.args.get('bot'))]})
+
+@app.route('/api/firmware/jobs/<job_id>', methods=['GET', 'DELETE'])
+def firmware_job(job_id):
+    """GET: job snapshot. DELETE: cancel it (a partial download is kept for resume)."""
+    job = firmware_jobs.cancel(job_id) if request.method == 'DELETE' else firmware_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown job: {job_id}'}), 404
+    return jsonify(job.snapshot())
+
+@app.route('/api/firmware/jobs/<job_id>/events')
+def firmware_job_events(job_id):
+    """Server-Sent Events: a job snapshot on every change until it finishes."""
+    job = firmware_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown job: {job_id}'}), 404
+
+    def events():
+        seen = -1
+        while True:
+            seq = job.wait(seen, timeout=15)
+            if seq == seen:
+                yield ': keep-alive\n\n'
+                continue
+            seen = seq
+            yield f"id: {seq}\ndata: {json.dumps(job.snapshot())}\n\n"
+            if job.finished:
+                return
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/firmware/<bot_name>/versions/<version>/pin', methods=['POST', 'DELETE'])
+def pin_firmware_version(bot_name, version):
+    """POST pins a cached version so quota eviction never removes it; DELETE unpins it."""
+    if bot_name not in firmware_managers:
+        return jsonify({'error': f'Invalid bot name: {bot_name}'}), 404
+    if not firmware_store.pin(bot_name, version, request.method == 'POST'):
+        return jsonify({'error': f'Version {version} is not cached for {bot_name}'}), 404
+    return jsonify({'success': True, 'pinned_versions': firmware_store.pinned(bot_name)})
+
+@app.route('/api/firmware/<bot_name>/releases')
+def firmware_releases(bot_name):
+    """Release list with notes from the persisted catalog (works offline); ?refresh=1 syncs now."""
+    try:
+        if bot_name not in firmware_managers:
+            return jsonify({'error': f'Invalid bot name: {bot_name}'}), 404
+        manager = firmware_managers[bot_name]
+        releases = manager.release_catalog.releases(refresh=bool(request.args.get('refresh')))
+        entries = [entry for entry in map(manager._release_entry, releases) if entry]
+        return jsonify({'releases': entries, 'catalog': manager.release_catalog.status()})
+    except Exception as e:
+        return jsonify({'error': f'Release list failed: {str(e)}'}), 500
+
+@app.route('/api/firmware/<bot_name>/delta/<from_version>/<to_version>')
+def firmware_delta(bot_name, from_version, to_version):
+    """Patch turning cached `from_version` into `to_version` (built once, then cached).
+    ?info=1 returns only the metadata; ?compression= picks the detools compression."""
+    try:
+        if bot_name not in firmware_managers:
+            return jsonify({'error': f'Invalid bot name: {bot_name}'}), 404
+        compression = request.args.get('compression', 'heatshrink')
+        if compression not in DELTA_COMPRESSIONS:
+            return jsonify({'error': f"compression must be one of {', '.join(DELTA_COMPRESSIONS)}"}), 400
+        if detools is None:
+            return jsonify({'error': 'Firmware deltas need the detools package'}), 501
+        shas = [firmware_store.version_sha256(bot_name, v) for v in (from_version, to_version)]
+        for version, sha256 in zip((from_version, to_version), shas):
+            if not sha256:
+                return jsonify({'error': f'Version {version} is not cached for {bot_name}'}), 404
+
+        meta, patch_path = firmware_store.delta(*shas, compression=compression)
+        meta = dict(meta, bot=bot_name, from_version=from_version, to_version=to_version,
+                    ratio=round(meta['size'] / meta['to_size'], 4))
+        if request.args.get('info'):
+            return jsonify(meta)
+        response = send_file(patch_path, mimetype='application/octet-stream', as_attachment=True,
+                             download_name=f"{bot_name}_{from_version}_to_{to_version}.patch",
+                             etag=meta['sha256'], conditional=True)
+        response.headers['X-Delta-Sha256'] = meta['sha256']
+        response.headers['X-Target-Sha256'] = meta['to_sha256']
+        response.headers['X-Target-Size'] = str(meta['to_size'])
+        return response
+    except Exception as e:
+        return jsonify({'error': f'Delta failed: {str(e)}'}), 500
+
+@app.route('/api/firmware/store', methods=['GET', 'POST'])
+def firmware_store_status():
+    """GET: store usage and dedup savings. POST: enforce the quota now."""
+    evicted = firmware_store.enforce_quota() if request.method == 'POST' else []
+    return jsonify(dict(firmware_store.stats(), evicted=evicted))
+
+@app.route('/api/github/status')
+def github_status():
+    """GitHub client counters and the last seen rate-limit headers."""
+    return jsonify(github.status())
+
+@app.route('/api/firmware/prefetch', methods=['GET', 'POST'])
+def firmware_prefetch():
+    """GET: prefetch state per bot. POST: start a prefetch pass now."""
+    if request.method == 'POST':
+        firmware_prefetcher.start()
+        firmware_prefetcher.trigger()
+    return jsonify(firmware_prefetcher.status())
+
 # ---------- Original Routes (unchanged) ----------
 
 @app.route('/')
@@ -566,81 +1832,2060 @@ def list_ports():
     except Exception as e:
         return jsonify({'error': f'Port detection failed: {str(e)}', 'ports': []}), 500
 
-def _generate_nvs_bin(csv_rows):
-    """Generate a temporary NVS .bin from given CSV rows. Returns bin_path."""
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False) as csv_file:
-        writer = csv.writer(csv_file)
-        writer.writerows(csv_rows)
-        csv_path = csv_file.name
+# ---------- Caching helpers ----------
 
-    bin_path = csv_path.replace('.csv', '.bin')
+class LruCache:
+    """Small thread-safe LRU map, bounded by item count and optionally by total len() of values."""
 
-    # Try multiple methods to call the generator
-    methods = [
-        ['python3', '-m', 'esp_idf_nvs_partition_gen.nvs_partition_gen', 'generate', csv_path, bin_path, '0x4000'],
-        ['python', '-m', 'esp_idf_nvs_partition_gen.nvs_partition_gen', 'generate', csv_path, bin_path, '0x4000'],
-        ['nvs_partition_gen', 'generate', csv_path, bin_path, '0x4000'],
-    ]
+    def __init__(self, max_items, max_bytes=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
 
-    last_err = ""
-    for cmd in methods:
-        try:
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
-            if result.returncode == 0 and os.path.exists(bin_path):
-                # cleanup CSV after success
-                try: os.unlink(csv_path)
-                except: pass
-                return bin_path
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._items:
+                self._drop(key)
+            self._items[key] = value
+            if self.max_bytes is not None:
+                self.size += len(value)
+            while self._items and (len(self._items) > self.max_items or
+                                   (self.max_bytes is not None and self.size > self.max_bytes)):
+                self._drop(next(iter(self._items)))
+
+    def _drop(self, key):
+        value = self._items.pop(key)
+        if self.max_bytes is not None:
+            self.size -= len(value)
+
+    def __len__(self):
+        return len(self._items)
+
+# ---------- NVS Generation (in-process) ----------
+
+NVS_PARTITION_SIZE = 0x4000
+NVS_VERSION = nvs_gen.Page.VERSION2  # same default as `nvs_partition_gen generate`
+NVS_MAX_KEY_LEN = 15
+
+def _nvs_size_params(size):
+    """Mirror nvs_partition_gen.check_size() without its sys.exit() calls.
+    Returns (usable_size, read_only) as expected by nvs_open()."""
+    page_size = nvs_gen.Page.PAGE_PARAMS['max_size']
+    if size % page_size != 0:
+        raise ValueError('Size of partition must be multiple of 4096')
+    if size < page_size:
+        raise ValueError('Minimum partition size for read-only NVS is 0x1000 bytes')
+    # One page is reserved for garbage collection on read/write partitions
+    usable_size = size - page_size
+    if usable_size < 2 * page_size:
+        return size, True
+    return usable_size, False
+
+# ---------- NVS Page Writer ----------
+
+NVS_PAGE_SIZE = nvs_gen.Page.PAGE_PARAMS['max_size']
+NVS_MAX_ENTRIES = nvs_gen.Page.PAGE_PARAMS['max_entries']
+NVS_PRIMITIVE_TYPES = {
+    'u8': (nvs_gen.Page.U8, struct.Struct('<B')), 'i8': (nvs_gen.Page.I8, struct.Struct('<b')),
+    'u16': (nvs_gen.Page.U16, struct.Struct('<H')), 'i16': (nvs_gen.Page.I16, struct.Struct('<h')),
+    'u32': (nvs_gen.Page.U32, struct.Struct('<I')), 'i32': (nvs_gen.Page.I32, struct.Struct('<i')),
+    'u64': (nvs_gen.Page.U64, struct.Struct('<Q')), 'i64': (nvs_gen.Page.I64, struct.Struct('<q')),
+}
+NVS_BLOB_ENCODINGS = {'binary', 'hex2bin', 'base64'}
+# Keys nvs_partition_gen.write_entry() expands into extra Wi-Fi entries; left to the reference writer
+NVS_WIFI_KEYS = {'ap.ssid', 'ap.passwd', 'ap.authmode', 'sta.ssid', 'sta.pswd'}
+
+_NVS_ENTRY = struct.Struct('<BBBBI16s8s')        # ns, type, span, chunk, crc, key, data
+_NVS_VARLEN_DATA = struct.Struct('<H2sI')        # size, reserved, data crc
+_NVS_BLOB_INDEX_DATA = struct.Struct('<IBB2s')   # total size, chunk count, chunk start, reserved
+_NVS_PAGE_HEADER = struct.Struct('<II')          # state, sequence number
+_NVS_U32 = struct.Struct('<I')
+_NVS_BLOB_FILL = re.compile(r'(blob_fill|blob_sz_fill)\((\d+);(0x[0-9a-fA-F]{2})\)')
+# Entry-state bitmap of a page with n written entries (two bits per entry, 0b10 = written)
+_NVS_BITMAPS = [(((1 << 256) - 1) ^ sum(1 << (2 * i) for i in range(n))).to_bytes(32, 'little')
+                for n in range(NVS_MAX_ENTRIES + 1)]
+
+class NvsWriter:
+    """Single-buffer NVS partition writer for large CSVs and multi-page blobs.
+
+    Lays entries out exactly like nvs_partition_gen (same page-full rules, blob chunking
+    and namespace indexing) but writes into one preallocated bytearray with precompiled
+    structs, stamps each page's bitmap once when the page is closed, and rejects a key
+    that is written twice in the same namespace.
+    """
+
+    def __init__(self, size=NVS_PARTITION_SIZE, version=NVS_VERSION):
+        usable_size, self.read_only = _nvs_size_params(size)
+        self.max_pages = usable_size // NVS_PAGE_SIZE
+        self.version = version
+        self.size = size
+        self.buf = self._allocate(size)
+        self.page = -1
+        self.entry = 0
+        self.namespaces = {}
+        self.namespace_count = 0
+        self.index = {}  # (namespace index, key) -> offset of the entry header
+        self._new_page()
+
+    def _allocate(self, size):
+        return bytearray(b'\xff') * size
+
+    def _new_page(self):
+        if self.page >= 0:
+            self._close_page()
+            _NVS_U32.pack_into(self.buf, self.page * NVS_PAGE_SIZE, nvs_gen.Page.FULL)
+        if self.page + 1 >= self.max_pages:
+            raise ValueError('Partition size is less than the size of data in csv. Please increase the size.')
+        self.page += 1
+        self.entry = 0
+        start = self.page * NVS_PAGE_SIZE
+        _NVS_PAGE_HEADER.pack_into(self.buf, start, nvs_gen.Page.ACTIVE, self.page)
+        self.buf[start + 8] = self.version
+        _NVS_U32.pack_into(self.buf, start + 28, zlib.crc32(self.buf[start + 4:start + 28], 0xFFFFFFFF) & 0xFFFFFFFF)
+
+    def _close_page(self):
+        start = self.page * NVS_PAGE_SIZE + nvs_gen.Page.BITMAPARRAY_OFFSET
+        self.buf[start:start + 32] = _NVS_BITMAPS[self.entry]
+
+    def _put_entry(self, ns_index, type_code, span, chunk_index, key_bytes, data):
+        offset = self.page * NVS_PAGE_SIZE + nvs_gen.Page.FIRST_ENTRY_OFFSET + self.entry * 32
+        crc = zlib.crc32(key_bytes + data, zlib.crc32(bytes((ns_index, type_code, span, chunk_index)), 0xFFFFFFFF))
+        _NVS_ENTRY.pack_into(self.buf, offset, ns_index, type_code, span, chunk_index, crc & 0xFFFFFFFF, key_bytes, data)
+        self.entry += 1
+        return offset
+
+    def _put_data(self, data):
+        offset = self.page * NVS_PAGE_SIZE + nvs_gen.Page.FIRST_ENTRY_OFFSET + self.entry * 32
+        self.buf[offset:offset + len(data)] = data
+        self.entry += (len(data) + 31) // 32
+
+    def _claim_key(self, ns_index, key):
+        key_bytes = key.encode()
+        if len(key) > NVS_MAX_KEY_LEN or len(key_bytes) > 15:
+            raise ValueError(f"Length of key `{key}` should be <= {NVS_MAX_KEY_LEN} characters.")
+        if (ns_index, key) in self.index:
+            raise ValueError(f"Duplicate key `{key}` in namespace {ns_index}")
+        return key_bytes.ljust(16, b'\0')
+
+    def write_namespace(self, name):
+        if name in self.namespaces:
+            return
+        key_bytes = self._claim_key(0, name)
+        self.namespace_count += 1
+        self.namespaces[name] = self.namespace_count
+        if self.entry >= NVS_MAX_ENTRIES:
+            self._new_page()
+        data = bytes((self.namespace_count,)) + b'\xff' * 7
+        self.index[(0, name)] = self._put_entry(0, nvs_gen.Page.U8, 1, nvs_gen.Page.CHUNK_ANY, key_bytes, data)
+
+    def write_primitive(self, key, encoding, value):
+        ns_index = self.namespace_count  # nvs_partition_gen always uses the latest namespace
+        key_bytes = self._claim_key(ns_index, key)
+        type_code, packer = NVS_PRIMITIVE_TYPES[encoding]
+        data = packer.pack(int(value)).ljust(8, b'\xff')
+        if self.entry >= NVS_MAX_ENTRIES:
+            self._new_page()
+        self.index[(ns_index, key)] = self._put_entry(ns_index, type_code, 1, nvs_gen.Page.CHUNK_ANY, key_bytes, data)
+
+    def write_varlen(self, key, encoding, data):
+        ns_index = self.namespace_count
+        key_bytes = self._claim_key(ns_index, key)
+        is_blob = encoding != 'string'
+        multipage = is_blob and self.version == nvs_gen.Page.VERSION2
+        max_blob_size = nvs_gen.Page.PAGE_PARAMS['max_blob_size'][self.version]
+        if not multipage and len(data) > max_blob_size:
+            raise ValueError(f"Size ({len(data)}) exceeds max allowed length `{max_blob_size}` bytes for key `{key}`.")
+
+        total_entries = (len(data) + 31) // 32 + 1
+        for attempt in range(2):
+            if self.entry < NVS_MAX_ENTRIES and (multipage or self.entry + total_entries < NVS_MAX_ENTRIES):
+                break
+            if attempt:
+                raise ValueError(f"Value for key `{key}` does not fit in a single page")
+            self._new_page()
+
+        type_code = nvs_gen.Page.BLOB if is_blob else nvs_gen.Page.SZ
+        if not multipage:
+            crc = zlib.crc32(data, 0xFFFFFFFF) & 0xFFFFFFFF
+            self.index[(ns_index, key)] = self._put_entry(
+                ns_index, type_code, total_entries, nvs_gen.Page.CHUNK_ANY, key_bytes,
+                _NVS_VARLEN_DATA.pack(len(data), b'\xff\xff', crc))
+            self._put_data(data)
+            return
+        self._write_multipage_blob(ns_index, key, key_bytes, data)
+
+    def _write_multipage_blob(self, ns_index, key, key_bytes, data):
+        """V2 blob: BLOB_DATA chunks filling each page's tailroom, then a BLOB_IDX entry."""
+        view = memoryview(data)
+        offset = chunk_count = 0
+        remaining = len(data)
+        first_offset = None
+        while True:
+            tailroom = (NVS_MAX_ENTRIES - self.entry - 1) * 32
+            chunk_size = min(tailroom, remaining)
+            remaining -= chunk_size
+            chunk = view[offset:offset + chunk_size]
+            crc = zlib.crc32(chunk, 0xFFFFFFFF) & 0xFFFFFFFF
+            header = self._put_entry(ns_index, nvs_gen.Page.BLOB_DATA, (chunk_size + 31) // 32 + 1, chunk_count,
+                                     key_bytes, _NVS_VARLEN_DATA.pack(chunk_size, b'\xff\xff', crc))
+            first_offset = header if first_offset is None else first_offset
+            self._put_data(chunk)
+            chunk_count += 1
+            if remaining or tailroom - chunk_size < 32:
+                self._new_page()
+            offset += chunk_size
+            if not remaining:
+                self._put_entry(ns_index, nvs_gen.Page.BLOB_IDX, 1, nvs_gen.Page.CHUNK_ANY, key_bytes,
+                                _NVS_BLOB_INDEX_DATA.pack(len(data), chunk_count, 0, b'\xff\xff'))
+                break
+        self.index[(ns_index, key)] = first_offset
+
+    def write_row(self, key, type_, encoding, value):
+        """Write one CSV row (key, type, encoding, value) like nvs_partition_gen.write_entry()."""
+        if type_ == 'namespace':
+            return self.write_namespace(key)
+        if type_ != 'data':
+            raise ValueError(f"{type_}: Unsupported type")
+        encoding = encoding.lower()
+        if encoding in NVS_PRIMITIVE_TYPES:
+            return self.write_primitive(key, encoding, value)
+        if encoding == 'string':
+            return self.write_varlen(key, encoding, (value + '\0').encode())
+        if encoding == 'hex2bin':
+            value = value.strip()
+            if len(value) % 2 != 0:
+                raise ValueError(f"{key}: Invalid data length. Should be multiple of 2.")
+            return self.write_varlen(key, encoding, binascii.a2b_hex(value))
+        if encoding == 'base64':
+            return self.write_varlen(key, encoding, binascii.a2b_base64(value))
+        if encoding == 'binary':
+            return self.write_varlen(key, encoding, value.encode() if isinstance(value, str) else bytes(value))
+        fill = _NVS_BLOB_FILL.fullmatch(encoding)
+        if fill:
+            length, padding = int(fill.group(2)), bytes((int(fill.group(3), 16),))
+            value_bytes = value.encode('utf-8') if value else b''
+            if len(value_bytes) > length:
+                raise ValueError(f"{key}: Value length exceeds specified length.")
+            data = value_bytes + padding * (length - len(value_bytes))
+            if fill.group(1) == 'blob_sz_fill':
+                data = _NVS_U32.pack(len(value_bytes)) + data
+            return self.write_varlen(key, 'hex2bin', data)
+        raise ValueError(f"{encoding}: Unsupported encoding")
+
+    def finish(self):
+        """Close the last page and return the partition image (the writer's own buffer)."""
+        self._close_page()
+        if self.read_only:
+            # Read-only partitions carry no erased tail or reserved page
+            del self.buf[(self.page + 1) * NVS_PAGE_SIZE:]
+        return self.buf
+
+def _needs_reference_writer(csv_rows):
+    """Rows that rely on nvs_partition_gen.write_entry() side effects (Wi-Fi expansion, file reads)."""
+    return any(row[0] in NVS_WIFI_KEYS or row[1] == 'file' for row in csv_rows[1:])
+
+def _generate_nvs_bytes(csv_rows, size=NVS_PARTITION_SIZE, engine='fast'):
+    """Generate an NVS partition image in-process from CSV rows (header row first).
+    engine='fast' uses NvsWriter; engine='reference' drives the nvs_partition_gen NVS/Page
+    classes directly. Both are byte-identical to the `generate` CLI; NvsWriter additionally
+    rejects duplicate keys."""
+    header, rows = csv_rows[0], csv_rows[1:]
+    if engine == 'fast' and not _needs_reference_writer(csv_rows):
+        writer = NvsWriter(size)
+        write_row = writer.write_row
+        columns = [header.index(name) for name in ('key', 'type', 'encoding', 'value')]
+        for row in rows:
+            write_row(*[row[i] for i in columns])
+        return writer.finish()
+
+    input_size, read_only = _nvs_size_params(size)
+    output = io.BytesIO()
+    nvs = nvs_gen.nvs_open(output, input_size, NVS_VERSION, read_only=read_only)
+    for row in rows:
+        entry = dict(zip(header, row))
+        if len(entry['key']) > NVS_MAX_KEY_LEN:
+            raise ValueError(f"Length of key `{entry['key']}` should be <= {NVS_MAX_KEY_LEN} characters.")
+        nvs_gen.write_entry(nvs, entry['key'], entry['type'], entry['encoding'], entry['value'])
+    nvs_gen.nvs_close(nvs)
+    return output.getvalue()
+
+# ---------- NVS Sizing Planner ----------
+
+class NvsPlanner(NvsWriter):
+    """Dry run of NvsWriter: same page-full rules, blob chunking and key checks, but only
+    counters move. No page buffers are allocated and running out of pages is not an error."""
+
+    def __init__(self, size=NVS_PARTITION_SIZE, version=NVS_VERSION):
+        # Counters first: NvsWriter.__init__ opens the first page through our _new_page()
+        self.entries = 0
+        self.largest_span = 0
+        self.blob_chunks = 0
+        self.page_entries = []
+        super().__init__(size, version)
+
+    def _allocate(self, size):
+        return None
+
+    def _new_page(self):
+        if self.page >= 0:
+            self.page_entries.append(self.entry)
+        self.page += 1
+        self.entry = 0
+
+    def _close_page(self):
+        pass
+
+    def _put_entry(self, ns_index, type_code, span, chunk_index, key_bytes, data):
+        self.largest_span = max(self.largest_span, span)
+        if type_code == nvs_gen.Page.BLOB_DATA:
+            self.blob_chunks += 1
+        self.entry += 1
+        self.entries += 1
+        return (self.page, self.entry - 1)
+
+    def _put_data(self, data):
+        span = (len(data) + 31) // 32
+        self.entry += span
+        self.entries += span
+
+    def finish(self):
+        pages = self.page + 1
+        free_entries = NVS_MAX_ENTRIES - self.entry + max(self.max_pages - pages, 0) * NVS_MAX_ENTRIES
+        return {
+            'size': self.size,
+            'version': self.version,
+            'read_only': self.read_only,
+            'namespaces': self.namespace_count,
+            'keys': len(self.index) - self.namespace_count,
+            'entries': self.entries,
+            'pages': pages,
+            'page_entries': self.page_entries + [self.entry],
+            'largest_span': self.largest_span,
+            'blob_chunks': self.blob_chunks,
+            'max_pages': self.max_pages,
+            'reserved_pages': 0 if self.read_only else 1,
+            'fits': pages <= self.max_pages,
+            'headroom_entries': free_entries if pages <= self.max_pages else 0,
+            'headroom_bytes': free_entries * 32 if pages <= self.max_pages else 0,
+            # Smallest read/write partition (data pages + the reserved page, never below 0x3000)
+            'min_size': max(pages + 1, 3) * NVS_PAGE_SIZE,
+        }
+
+def plan_nvs(csv_rows, size=NVS_PARTITION_SIZE, version=NVS_VERSION):
+    """Entry/page/span counts and headroom for CSV rows (header row first) without generating."""
+    if _needs_reference_writer(csv_rows):
+        raise ValueError('Wi-Fi keys and file rows are not supported by the planner')
+    header, rows = csv_rows[0], csv_rows[1:]
+    planner = NvsPlanner(size, version)
+    columns = [header.index(name) for name in ('key', 'type', 'encoding', 'value')]
+    for row in rows:
+        planner.write_row(*[row[i] for i in columns])
+    return planner.finish()
+
+# ---------- NVS Template Compiler ----------
+
+# Entries that change from robot to robot. Everything else in a partition is fixed per
+# (robot_model, key set), so the page layout is built once and only these slots are patched.
+NVS_PATCHABLE_KEYS = {'device_id', 'left_motor_scal', 'right_motor_sca'}
+NVS_TEMPLATE_CACHE_SIZE = 64
+_nvs_templates = {}
+_nvs_templates_lock = Lock()
+
+def _nvs_entry_crc(buf, offset):
+    """CRC32 of a 32-byte entry header, skipping its own CRC field (same as Page.set_crc_header)."""
+    crc = zlib.crc32(buf[offset:offset + 4], 0xFFFFFFFF)
+    crc = zlib.crc32(buf[offset + 8:offset + 32], crc)
+    struct.pack_into('<I', buf, offset + 4, crc & 0xFFFFFFFF)
+
+def _nvs_entry_offsets(image):
+    """Walk the written entries of every page and return {key: [entry offsets]}."""
+    page_size = nvs_gen.Page.PAGE_PARAMS['max_size']
+    max_entries = nvs_gen.Page.PAGE_PARAMS['max_entries']
+    offsets = {}
+    for page in range(0, len(image), page_size):
+        if image[page:page + 4] == b'\xff\xff\xff\xff':
+            continue  # empty page
+        entry = 0
+        while entry < max_entries:
+            offset = page + nvs_gen.Page.FIRST_ENTRY_OFFSET + entry * nvs_gen.Page.SINGLE_ENTRY_SIZE
+            if image[offset + 1] == 0xFF:
+                entry += 1
+                continue
+            key = bytes(image[offset + 8:offset + 24]).split(b'\0', 1)[0].decode('utf-8', 'replace')
+            offsets.setdefault(key, []).append(offset)
+            entry += max(image[offset + 2], 1)
+    return offsets
+
+def _nvs_string_span(value):
+    """Number of data entries a string value (with its NUL) occupies."""
+    return (len(value.encode()) + 1 + 31) // 32
+
+class NvsTemplate:
+    """A generated partition plus the offsets of its patchable entries."""
+
+    def __init__(self, image, slots):
+        self.image = bytes(image)
+        self.slots = slots  # key -> (entry offset, encoding)
+
+    def render(self, values):
+        """Return a new image with `values` ({key: value}) patched into their slots."""
+        buf = bytearray(self.image)
+        for key, value in values.items():
+            offset, encoding = self.slots[key]
+            if encoding == 'string':
+                data = value.encode() + b'\0'
+                span = buf[offset + 2] - 1
+                buf[offset + 32:offset + 32 + span * 32] = data.ljust(span * 32, b'\xff')
+                struct.pack_into('<H', buf, offset + 24, len(data))
+                struct.pack_into('<I', buf, offset + 28, zlib.crc32(data, 0xFFFFFFFF) & 0xFFFFFFFF)
             else:
-                last_err = f"{' '.join(cmd)} -> rc={result.returncode}, out={result.stdout}, err={result.stderr}"
+                NVS_PRIMITIVE_TYPES[encoding][1].pack_into(buf, offset + 24, int(value))
+            _nvs_entry_crc(buf, offset)
+        return bytes(buf)
+
+def _nvs_template_key(csv_rows, size):
+    """Cache key: every row verbatim, except patchable values which only contribute their shape."""
+    shape = []
+    for key, type_, encoding, value in csv_rows[1:]:
+        if key in NVS_PATCHABLE_KEYS and type_ == 'data':
+            if encoding == 'string':
+                value = ('span', _nvs_string_span(value))
+            elif encoding in NVS_PRIMITIVE_TYPES:
+                value = None
+        shape.append((key, type_, encoding, value))
+    return (NVS_VERSION, size, tuple(csv_rows[0]), tuple(shape))
+
+def _compile_nvs_template(csv_rows, size):
+    """Build the full image once and locate its patchable entries. Returns None if a
+    patchable key is ambiguous (e.g. repeated), in which case callers rebuild in full."""
+    image = _generate_nvs_bytes(csv_rows, size)
+    offsets = _nvs_entry_offsets(image)
+    slots = {}
+    for key, type_, encoding, _ in csv_rows[1:]:
+        if key not in NVS_PATCHABLE_KEYS or type_ != 'data':
+            continue
+        if encoding != 'string' and encoding not in NVS_PRIMITIVE_TYPES:
+            continue
+        if key in slots or len(offsets.get(key, [])) != 1:
+            return None
+        slots[key] = (offsets[key][0], encoding)
+    return NvsTemplate(image, slots)
+
+def _render_nvs(csv_rows, size=NVS_PARTITION_SIZE):
+    """Generate an NVS image, reusing a cached layout and patching only per-device entries.
+    Output is byte-identical to _generate_nvs_bytes()."""
+    cache_key = _nvs_template_key(csv_rows, size)
+    with _nvs_templates_lock:
+        template = _nvs_templates.get(cache_key)
+    if template is None:
+        template = _compile_nvs_template(csv_rows, size)
+        if template is None:
+            return _generate_nvs_bytes(csv_rows, size)
+        with _nvs_templates_lock:
+            if len(_nvs_templates) >= NVS_TEMPLATE_CACHE_SIZE:
+                _nvs_templates.pop(next(iter(_nvs_templates)))
+            _nvs_templates[cache_key] = template
+    values = {row[0]: row[3] for row in csv_rows[1:] if row[0] in template.slots}
+    return template.render(values)
+
+# ---------- NVS Encryption ----------
+
+NVS_KEY_FILE = os.environ.get('NVS_KEY_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'keys', 'nvs_keys.bin'))
+NVS_KEY_LEN = 64                 # XTS-AES-256: data key + tweak key
+NVS_PARALLEL_CRYPT_PAGES = 64    # encrypt pages in the process pool above this many
+_NVS_GF_MASK = (1 << 128) - 1
+_nvs_keys = {}
+_nvs_keys_lock = Lock()
+
+def _parse_nvs_key(data, source='key'):
+    """Validate an NVS key partition image and return its 64 raw key bytes."""
+    if len(data) < NVS_KEY_LEN:
+        raise ValueError(f'NVS {source} is shorter than {NVS_KEY_LEN} bytes')
+    key = bytes(data[:NVS_KEY_LEN])
+    stored_crc = bytes(data[NVS_KEY_LEN:NVS_KEY_LEN + 4])
+    if len(stored_crc) == 4 and stored_crc != b'\xff\xff\xff\xff':
+        if _NVS_U32.unpack(stored_crc)[0] != zlib.crc32(key, 0xFFFFFFFF) & 0xFFFFFFFF:
+            raise ValueError(f'NVS {source} failed its CRC check')
+    return key
+
+def _load_nvs_key(path=None):
+    """Read and validate an NVS key partition (as written by `nvs_partition_gen generate-key`)
+    once per process. Returns the 64 raw key bytes."""
+    path = path or NVS_KEY_FILE
+    with _nvs_keys_lock:
+        if path not in _nvs_keys:
+            with open(path, 'rb') as f:
+                _nvs_keys[path] = _parse_nvs_key(f.read(NVS_KEY_LEN + 4), f'key file {path}')
+        return _nvs_keys[path]
+
+def _nvs_written_entries(image, first_page=0):
+    """Flash offsets of every written entry (bitmap state != empty) on non-empty pages."""
+    offsets = []
+    for page in range(0, len(image), NVS_PAGE_SIZE):
+        if image[page:page + 4] == b'\xff\xff\xff\xff':
+            continue
+        bitmap = int.from_bytes(image[page + 32:page + 64], 'little')
+        base = first_page * NVS_PAGE_SIZE + page + nvs_gen.Page.FIRST_ENTRY_OFFSET
+        offsets.extend(base + i * 32 for i in range(NVS_MAX_ENTRIES) if (bitmap >> (2 * i)) & 3 != 3)
+    return offsets
+
+class NvsXts:
+    """XTS-AES-256 over NVS entries. Each 32-byte entry is one data unit whose tweak is its
+    flash offset; all entries of a batch go through two AES-ECB passes instead of one cipher each."""
+
+    def __init__(self, key):
+        if len(key) != NVS_KEY_LEN:
+            raise ValueError(f'NVS encryption key must be {NVS_KEY_LEN} bytes')
+        self._data_cipher = Cipher(algorithms.AES(key[:32]), modes.ECB())
+        self._tweak_cipher = Cipher(algorithms.AES(key[32:]), modes.ECB())
+
+    def _tweaks(self, offsets):
+        """T0 = AES(tweak key, offset), T1 = T0 * alpha in GF(2^128), per entry."""
+        encrypted = self._tweak_cipher.encryptor().update(b''.join(o.to_bytes(16, 'little') for o in offsets))
+        stream = []
+        for i in range(len(offsets)):
+            t0 = encrypted[16 * i:16 * i + 16]
+            value = int.from_bytes(t0, 'little')
+            t1 = ((value << 1) & _NVS_GF_MASK) ^ (0x87 if value >> 127 else 0)
+            stream.append(t0)
+            stream.append(t1.to_bytes(16, 'little'))
+        return int.from_bytes(b''.join(stream), 'little')
+
+    def crypt(self, buf, offsets, decrypt=False, base=0):
+        """Encrypt/decrypt the entries at `offsets` (flash offsets; buf starts at `base`) in place."""
+        if not offsets:
+            return buf
+        size = 32 * len(offsets)
+        tweaks = self._tweaks(offsets)
+        data = b''.join(buf[o - base:o - base + 32] for o in offsets)
+        masked = (int.from_bytes(data, 'little') ^ tweaks).to_bytes(size, 'little')
+        cipher = self._data_cipher.decryptor() if decrypt else self._data_cipher.encryptor()
+        result = (int.from_bytes(cipher.update(masked), 'little') ^ tweaks).to_bytes(size, 'little')
+        for i, o in enumerate(offsets):
+            buf[o - base:o - base + 32] = result[32 * i:32 * i + 32]
+        return buf
+
+_NVS_EMPTY_ENTRY = b'\xff' * 32
+
+def _nvs_nonempty_entries(image, first_page=0):
+    """Flash offsets of every entry slot holding anything but 0xFF, which is what
+    `nvs_partition_gen decrypt` decrypts. The bitmap is ignored so erased entries are
+    decrypted too. Each page's trailing 0xFF run is found with one C-level rstrip."""
+    offsets = []
+    first = nvs_gen.Page.FIRST_ENTRY_OFFSET
+    for page in range(0, len(image), NVS_PAGE_SIZE):
+        region = bytes(image[page + first:page + NVS_PAGE_SIZE])
+        used = (len(region.rstrip(b'\xff')) + 31) // 32
+        base = first_page * NVS_PAGE_SIZE + page + first
+        offsets.extend(base + i * 32 for i in range(used) if region[i * 32:i * 32 + 32] != _NVS_EMPTY_ENTRY)
+    return offsets
+
+def _nvs_crypt_pages(key, chunk, first_page, decrypt=False):
+    """Process-pool worker: encrypt/decrypt the entries of a run of whole pages."""
+    chunk = bytearray(chunk)
+    select = _nvs_nonempty_entries if decrypt else _nvs_written_entries
+    return bytes(NvsXts(key).crypt(chunk, select(chunk, first_page), decrypt, base=first_page * NVS_PAGE_SIZE))
+
+def _crypt_nvs_image(image, key, decrypt=False):
+    """Encrypt (or decrypt) a whole NVS image like `nvs_partition_gen encrypt`/`decrypt`:
+    page headers and bitmaps stay plain, every written entry is XTS-transformed.
+    The result is one preallocated copy of the input (bytes, bytearray or mmap);
+    large images are split into page runs and handled in parallel."""
+    buf = bytearray(image)
+    pages = len(buf) // NVS_PAGE_SIZE
+    if pages <= NVS_PARALLEL_CRYPT_PAGES or _in_nvs_pool_worker:
+        select = _nvs_nonempty_entries if decrypt else _nvs_written_entries
+        return NvsXts(key).crypt(buf, select(buf), decrypt)
+
+    pool = _get_nvs_pool()
+    step = max(1, -(-pages // NVS_POOL_WORKERS))
+    starts = range(0, pages, step)
+    chunks = [bytes(buf[p * NVS_PAGE_SIZE:(p + step) * NVS_PAGE_SIZE]) for p in starts]
+    results = pool.map(_nvs_crypt_pages, [key] * len(chunks), chunks, starts, [decrypt] * len(chunks))
+    for first_page, data in zip(starts, results):
+        buf[first_page * NVS_PAGE_SIZE:first_page * NVS_PAGE_SIZE + len(data)] = data
+    return buf
+
+def decrypt_nvs_file(path, key, output_path=None):
+    """Memory-map an encrypted partition and decrypt it into a single buffer.
+    Optionally writes the plain image to `output_path`. Returns the buffer."""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        plain = _crypt_nvs_image(mapped, key, decrypt=True)
+    if output_path:
+        with open(output_path, 'wb') as out:
+            out.write(plain)
+    return plain
+
+# ---------- Per-device NVS Keys ----------
+
+# With a master HMAC key present, every robot gets its own XTS key:
+#   device HMAC key = HMAC-SHA256(master, "bonicbot-nvs\0" + device_id)
+#   XTS key         = HMAC(device key, EKEY seed) + HMAC(device key, TKEY seed)
+# The second step is ESP-IDF's HMAC key-protection scheme (`generate-key --key_protect_hmac`),
+# so the device HMAC key can also be burned to eFuse instead of flashing a key partition.
+NVS_HMAC_KEY_FILE = os.environ.get('NVS_HMAC_KEY_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'keys', 'nvs_hmac_key.bin'))
+NVS_HMAC_KEY_LEN = 32
+NVS_DEVICE_KEY_CACHE_SIZE = 10000
+NVS_KEY_PARTITION_CACHE_SIZE = 1024  # finished 4 KB partitions for recent reflashes
+_NVS_EKEY_SEED = b'\x5A\x5A\xBE\xAE' * 8
+_NVS_TKEY_SEED = b'\xA5\xA5\xDE\xCE' * 8
+_NVS_DEVICE_KEY_LABEL = b'bonicbot-nvs\0'
+_NVS_KEY_PARTITION_TAIL = b'\xff' * (NVS_PAGE_SIZE - NVS_KEY_LEN - 4)
+_nvs_device_keys = LruCache(NVS_DEVICE_KEY_CACHE_SIZE)
+_nvs_device_key_partitions = LruCache(NVS_KEY_PARTITION_CACHE_SIZE)
+_nvs_master_fingerprints = {}  # master key -> SHA-256, so cache keys never hold the key itself
+
+def create_nvs_hmac_key(path=None):
+    """Create the master HMAC key from the OS CSPRNG. Refuses to overwrite an existing key."""
+    path = path or NVS_HMAC_KEY_FILE
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(secrets.token_bytes(NVS_HMAC_KEY_LEN))
+    return path
+
+def _load_nvs_hmac_key(path=None):
+    """Read the master HMAC key once per process."""
+    path = path or NVS_HMAC_KEY_FILE
+    with _nvs_keys_lock:
+        if path not in _nvs_keys:
+            with open(path, 'rb') as f:
+                key = f.read()
+            if len(key) != NVS_HMAC_KEY_LEN:
+                raise ValueError(f'NVS HMAC key {path} must be {NVS_HMAC_KEY_LEN} bytes')
+            _nvs_keys[path] = key
+            _nvs_master_fingerprints[key] = hashlib.sha256(key).digest()
+        return _nvs_keys[path]
+
+def _nvs_master_fingerprint(master):
+    fingerprint = _nvs_master_fingerprints.get(master)
+    if fingerprint is None:  # a master passed in directly instead of loaded from its file
+        fingerprint = _nvs_master_fingerprints.setdefault(master, hashlib.sha256(master).digest())
+    return fingerprint
+
+def _nvs_hmac_xts_key(hmac_key):
+    """ESP-IDF HMAC scheme: XTS key = HMAC(key, EKEY seed) || HMAC(key, TKEY seed)."""
+    return hmac.digest(hmac_key, _NVS_EKEY_SEED, 'sha256') + hmac.digest(hmac_key, _NVS_TKEY_SEED, 'sha256')
+
+def derive_device_keys(device_id, master=None):
+    """Return (device HMAC key, XTS key) for a robot; cached so reflashing costs no crypto."""
+    master = master or _load_nvs_hmac_key()
+    cache_key = (_nvs_master_fingerprint(master), device_id)
+    keys = _nvs_device_keys.get(cache_key)
+    if keys is None:
+        device_hmac = hmac.digest(master, _NVS_DEVICE_KEY_LABEL + device_id.encode(), 'sha256')
+        keys = (device_hmac, _nvs_hmac_xts_key(device_hmac))
+        _nvs_device_keys.put(cache_key, keys)
+    return keys
+
+def nvs_key_partition(xts_key):
+    """4 KB NVS key partition: key, CRC32 of the key, 0xFF fill."""
+    crc = zlib.crc32(xts_key, 0xFFFFFFFF) & 0xFFFFFFFF
+    return xts_key + _NVS_U32.pack(crc) + _NVS_KEY_PARTITION_TAIL
+
+def device_key_partition(device_id, master=None):
+    """A robot's 4 KB key partition, cached whole so a reflash does no hashing or CRC."""
+    master = master or _load_nvs_hmac_key()
+    cache_key = (_nvs_master_fingerprint(master), device_id)
+    partition = _nvs_device_key_partitions.get(cache_key)
+    if partition is None:
+        partition = nvs_key_partition(derive_device_keys(device_id, master)[1])
+        _nvs_device_key_partitions.put(cache_key, partition)
+    return partition
+
+def nvs_key_partitions(device_ids, master=None):
+    """Key partitions for a whole batch in one pass: {device_id: 4 KB image}. Not routed through
+    the partition cache, so a bulk export doesn't push out the robots being reflashed."""
+    master = master or _load_nvs_hmac_key()
+    return {device_id: nvs_key_partition(derive_device_keys(device_id, master)[1]) for device_id in device_ids}
+
+def _nvs_per_device_keys():
+    return os.path.exists(NVS_HMAC_KEY_FILE)
+
+def _nvs_key_for(device_id):
+    """Per-device key when a master HMAC key is configured, otherwise the station key."""
+    if _nvs_per_device_keys():
+        return derive_device_keys(device_id)[1]
+    return _load_nvs_key()
+
+# ---------- NVS Inspector ----------
+
+NVS_PAGE_STATES = {
+    0xFFFFFFFF: 'empty', 0xFFFFFFFE: 'active', 0xFFFFFFFC: 'full',
+    0xFFFFFFF8: 'freeing', 0xFFFFFFF0: 'corrupt',
+}
+NVS_TYPE_NAMES = {code: encoding for encoding, (code, _) in NVS_PRIMITIVE_TYPES.items()}
+NVS_TYPE_NAMES.update({nvs_gen.Page.SZ: 'string', nvs_gen.Page.BLOB: 'blob',
+                       nvs_gen.Page.BLOB_DATA: 'blob_data', nvs_gen.Page.BLOB_IDX: 'blob_index'})
+_NVS_ENTRY_STATE_WRITTEN = 0b10
+_NVS_ENTRY_STATE_EMPTY = 0b11
+
+class NvsImage:
+    """Read-only parser for an NVS partition image (bytes, bytearray or mmap).
+
+    Page headers and entry/data CRCs are validated while the (namespace, key) index is
+    built, which happens lazily on first lookup. Values are decoded only when asked for.
+    """
+
+    def __init__(self, data, name=None):
+        self.name = name
+        self._data = memoryview(data)
+        self._mmap = None
+        self._file = None
+        self._pages = None
+        self._index = None
+        self._blob_chunks = None
+        self.namespaces = {}
+        self.errors = []
+
+    @classmethod
+    def open(cls, path, key=None):
+        """Memory-map a partition file instead of reading it. With an XTS `key` the
+        file is decrypted (page-parallel) into memory first."""
+        if key is not None:
+            return cls(decrypt_nvs_file(path, key), name=os.path.basename(path))
+        f = open(path, 'rb')
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            mapped = b''
+        image = cls(mapped, name=os.path.basename(path))
+        image._file, image._mmap = f, mapped if isinstance(mapped, mmap.mmap) else None
+        return image
+
+    def close(self):
+        self._data.release()
+        if self._mmap is not None:
+            self._mmap.close()
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def size(self):
+        return len(self._data)
+
+    def pages(self):
+        """Page headers in flash order: offset, state, sequence number, version, crc_ok."""
+        if self._pages is None:
+            self._pages = []
+            if len(self._data) % NVS_PAGE_SIZE:
+                self.errors.append(f'Image size {len(self._data)} is not a multiple of {NVS_PAGE_SIZE}')
+            for offset in range(0, len(self._data) - NVS_PAGE_SIZE + 1, NVS_PAGE_SIZE):
+                state, seq = _NVS_PAGE_HEADER.unpack_from(self._data, offset)
+                page = {'offset': offset, 'state': NVS_PAGE_STATES.get(state, hex(state)), 'seq': seq,
+                        'version': self._data[offset + 8], 'crc_ok': True}
+                if state != 0xFFFFFFFF:
+                    crc = zlib.crc32(self._data[offset + 4:offset + 28], 0xFFFFFFFF) & 0xFFFFFFFF
+                    page['crc_ok'] = crc == _NVS_U32.unpack_from(self._data, offset + 28)[0]
+                    if not page['crc_ok']:
+                        self.errors.append(f'Page @0x{offset:x}: header CRC mismatch')
+                    if page['state'] not in ('active', 'full', 'freeing'):
+                        self.errors.append(f"Page @0x{offset:x}: unexpected state {page['state']}")
+                self._pages.append(page)
+        return self._pages
+
+    def _entries(self, page):
+        """Yield (offset, span) of every written entry on a page whose CRCs check out."""
+        data = self._data
+        bitmap = int.from_bytes(data[page + 32:page + 64], 'little')
+        entry = 0
+        while entry < NVS_MAX_ENTRIES:
+            state = (bitmap >> (2 * entry)) & 3
+            offset = page + nvs_gen.Page.FIRST_ENTRY_OFFSET + entry * 32
+            if state == _NVS_ENTRY_STATE_EMPTY:
+                entry += 1
+                continue
+            crc = zlib.crc32(data[offset + 8:offset + 32], zlib.crc32(data[offset:offset + 4], 0xFFFFFFFF)) & 0xFFFFFFFF
+            if crc != _NVS_U32.unpack_from(data, offset + 4)[0]:
+                if state == _NVS_ENTRY_STATE_WRITTEN:
+                    self.errors.append(f'Entry @0x{offset:x}: header CRC mismatch')
+                entry += 1
+                continue
+            span = data[offset + 2]
+            if not 1 <= span <= NVS_MAX_ENTRIES - entry:
+                self.errors.append(f'Entry @0x{offset:x}: invalid span {span}')
+                entry += 1
+                continue
+            if state == _NVS_ENTRY_STATE_WRITTEN:
+                yield offset, span
+            entry += span
+
+    def _check_data_crc(self, offset):
+        size, _, crc = _NVS_VARLEN_DATA.unpack_from(self._data, offset + 24)
+        if zlib.crc32(self._data[offset + 32:offset + 32 + size], 0xFFFFFFFF) & 0xFFFFFFFF != crc:
+            self.errors.append(f'Entry @0x{offset:x}: data CRC mismatch')
+            return False
+        return True
+
+    def _build_index(self):
+        index, chunks = {}, {}
+        live_pages = [p for p in self.pages() if p['state'] != 'empty' and p['crc_ok']]
+        for page in sorted(live_pages, key=lambda p: p['seq']):
+            for offset, span in self._entries(page['offset']):
+                ns_index, type_code, _, chunk_index = self._data[offset:offset + 4]
+                key = bytes(self._data[offset + 8:offset + 24]).split(b'\0', 1)[0].decode('utf-8', 'replace')
+                if type_code in (nvs_gen.Page.SZ, nvs_gen.Page.BLOB, nvs_gen.Page.BLOB_DATA):
+                    if not self._check_data_crc(offset):
+                        continue
+                if type_code == nvs_gen.Page.BLOB_DATA:
+                    chunks[(ns_index, key, chunk_index)] = offset
+                    continue
+                if ns_index == 0 and type_code == nvs_gen.Page.U8:
+                    self.namespaces[key] = self._data[offset + 24]
+                    continue
+                index[(ns_index, key)] = offset  # later pages win, like nvs_flash
+        self._index, self._blob_chunks = index, chunks
+
+    @property
+    def index(self):
+        """{(namespace index, key): entry header offset}"""
+        if self._index is None:
+            self._build_index()
+        return self._index
+
+    def _namespace_names(self):
+        self.index  # building the index also fills self.namespaces
+        return {idx: name for name, idx in self.namespaces.items()}
+
+    def entry_type(self, offset):
+        return NVS_TYPE_NAMES.get(self._data[offset + 1], hex(self._data[offset + 1]))
+
+    def decode(self, offset):
+        """Decode the value whose header entry is at `offset`."""
+        data = self._data
+        type_code = data[offset + 1]
+        for code, packer in NVS_PRIMITIVE_TYPES.values():
+            if code == type_code:
+                return packer.unpack_from(data, offset + 24)[0]
+        if type_code in (nvs_gen.Page.SZ, nvs_gen.Page.BLOB):
+            size = _NVS_VARLEN_DATA.unpack_from(data, offset + 24)[0]
+            value = bytes(data[offset + 32:offset + 32 + size])
+            return value.rstrip(b'\0').decode('utf-8', 'replace') if type_code == nvs_gen.Page.SZ else value
+        if type_code == nvs_gen.Page.BLOB_IDX:
+            total, count, start, _ = _NVS_BLOB_INDEX_DATA.unpack_from(data, offset + 24)
+            ns_index = data[offset]
+            key = bytes(data[offset + 8:offset + 24]).split(b'\0', 1)[0].decode('utf-8', 'replace')
+            parts = []
+            for chunk_index in range(start, start + count):
+                chunk = self._blob_chunks.get((ns_index, key, chunk_index))
+                if chunk is None:
+                    raise ValueError(f'Blob `{key}` is missing chunk {chunk_index}')
+                size = _NVS_VARLEN_DATA.unpack_from(data, chunk + 24)[0]
+                parts.append(data[chunk + 32:chunk + 32 + size])
+            value = b''.join(parts)
+            if len(value) != total:
+                raise ValueError(f'Blob `{key}` is {len(value)} bytes, index says {total}')
+            return value
+        raise ValueError(f'Unknown entry type 0x{type_code:02x}')
+
+    def get(self, namespace, key):
+        """Decoded value of namespace/key, or KeyError."""
+        index = self.index
+        offset = index.get((self.namespaces.get(namespace), key))
+        if offset is None:
+            raise KeyError(f'{namespace}/{key}')
+        return self.decode(offset)
+
+    def items(self):
+        """Yield (namespace, key, type, value) for every live entry."""
+        names = self._namespace_names()
+        for (ns_index, key), offset in self.index.items():
+            try:
+                value = self.decode(offset)
+            except ValueError as e:
+                self.errors.append(f'{key}: {e}')
+                continue
+            yield names.get(ns_index, f'#{ns_index}'), key, self.entry_type(offset), value
+
+    def signature(self, offset):
+        """Cheap identity of an entry's value: CRC-protected header fields, no decoding."""
+        return bytes(self._data[offset + 1:offset + 2]) + bytes(self._data[offset + 24:offset + 32])
+
+    def summary(self):
+        """JSON-friendly description: pages, namespaces, entries and validation errors."""
+        entries = [{'namespace': ns, 'key': key, 'type': type_, 'value': _nvs_json_value(value)}
+                   for ns, key, type_, value in self.items()]
+        return {
+            'name': self.name,
+            'size': self.size,
+            'pages': [{k: v for k, v in page.items() if k != 'offset'} | {'offset': hex(page['offset'])}
+                      for page in self.pages()],
+            'namespaces': self.namespaces,
+            'entries': entries,
+            'errors': self.errors,
+            'valid': not self.errors,
+        }
+
+def _nvs_json_value(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {'hex': bytes(value).hex(), 'size': len(value)}
+    return value
+
+def _audit_nvs_file(path, key=None):
+    """Process-pool worker for audit_nvs_files()."""
+    try:
+        with NvsImage.open(path, key) as image:
+            return path, image.summary()
+    except Exception as e:
+        return path, {'name': os.path.basename(path), 'errors': [str(e)], 'valid': False}
+
+def audit_nvs_files(paths, key=None):
+    """Inspect many (optionally encrypted) partition dumps across the process pool.
+    Yields (path, summary) in completion order."""
+    pool = _get_nvs_pool()
+    futures = {pool.submit(_audit_nvs_file, path, key): path for path in paths}
+    try:
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:  # worker died (e.g. broken pool); report it against its file
+                path = futures[future]
+                yield path, {'name': os.path.basename(path), 'errors': [str(e)], 'valid': False}
+    finally:
+        for future in futures:
+            future.cancel()
+
+def nvs_diff(a, b):
+    """Structural diff of two NvsImages by (namespace, key). Identical images short-circuit on
+    raw bytes; otherwise entries are compared by their CRC-covered header fields and only
+    differing values are decoded."""
+    if a._data == b._data:  # memoryview comparison: the mmaps are never copied
+        return {'identical': True, 'added': [], 'removed': [], 'changed': []}
+    names_a, names_b = a._namespace_names(), b._namespace_names()
+    keyed_a = {(names_a.get(ns, f'#{ns}'), key): off for (ns, key), off in a.index.items()}
+    keyed_b = {(names_b.get(ns, f'#{ns}'), key): off for (ns, key), off in b.index.items()}
+
+    def describe(image, name, offset):
+        try:
+            value = _nvs_json_value(image.decode(offset))
+        except ValueError as e:
+            value = {'error': str(e)}
+        return {'namespace': name[0], 'key': name[1], 'type': image.entry_type(offset), 'value': value}
+
+    added = [describe(b, k, keyed_b[k]) for k in keyed_b.keys() - keyed_a.keys()]
+    removed = [describe(a, k, keyed_a[k]) for k in keyed_a.keys() - keyed_b.keys()]
+    changed = []
+    for k in keyed_a.keys() & keyed_b.keys():
+        if a.signature(keyed_a[k]) != b.signature(keyed_b[k]) or (
+                a.entry_type(keyed_a[k]) == 'blob_index' and a.decode(keyed_a[k]) != b.decode(keyed_b[k])):
+            old, new = describe(a, k, keyed_a[k]), describe(b, k, keyed_b[k])
+            changed.append({'namespace': k[0], 'key': k[1], 'old': old['value'], 'new': new['value']})
+    return {'identical': not (added or removed or changed), 'added': added, 'removed': removed, 'changed': changed}
+
+# ---------- Device ID Allocator ----------
+
+# Shared by every station: IDs are leased from a per-prefix sequence in SQLite (WAL, fsync on
+# commit), so two tablets can never be handed the same robot ID. Unused leases can be returned
+# (or simply expire) and are reissued lowest number first.
+DEVICE_ID_DB = os.environ.get('DEVICE_ID_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'device_ids.sqlite3'))
+DEVICE_ID_LEASE_SECONDS = 3600
+MAX_DEVICE_ID_WIDTH = 12
+_DEVICE_ID_NUMBER = re.compile(r'^(.*?)(\d+)$')  # same split as predictNextId in the UI
+
+class DeviceIdAllocator:
+    """Crash-safe, multi-process device ID sequences with lease/return."""
+
+    def __init__(self, path=DEVICE_ID_DB):
+        self.path = path
+        self._conn = None
+        self._lock = Lock()
+
+    def _db(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=FULL')
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS sequences (prefix TEXT PRIMARY KEY, next INTEGER NOT NULL);
+                CREATE TABLE IF NOT EXISTS device_ids (
+                    device_id TEXT PRIMARY KEY, prefix TEXT NOT NULL, number INTEGER NOT NULL,
+                    state TEXT NOT NULL, station TEXT NOT NULL DEFAULT '',
+                    updated_at REAL NOT NULL, expires_at REAL);
+                CREATE INDEX IF NOT EXISTS device_ids_free ON device_ids (prefix, state, number);
+            """)
+            self._conn = conn
+        return self._conn
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            db = self._db()
+            db.execute('BEGIN IMMEDIATE')  # takes the write lock up front; other processes wait
+            try:
+                yield db
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+    def reserve(self, prefix, count=1, width=4, start=1, station='', lease_seconds=DEVICE_ID_LEASE_SECONDS):
+        """Lease `count` IDs for a prefix: returned/expired ones first, then fresh numbers."""
+        if not 1 <= count <= MAX_BATCH_DEVICES:
+            raise ValueError(f'Reserve between 1 and {MAX_BATCH_DEVICES} device IDs')
+        if not 1 <= width <= MAX_DEVICE_ID_WIDTH:
+            raise ValueError(f'ID width must be between 1 and {MAX_DEVICE_ID_WIDTH}')
+        if lease_seconds <= 0:
+            raise ValueError('lease_seconds must be positive')
+        now = time.time()
+        expires_at = now + lease_seconds
+        with self._transaction() as db:
+            reused = [row[0] for row in db.execute(
+                "SELECT device_id FROM device_ids WHERE prefix = ? AND "
+                "(state = 'returned' OR (state = 'leased' AND expires_at < ?)) ORDER BY number LIMIT ?",
+                (prefix, now, count))]
+            db.executemany("UPDATE device_ids SET state = 'leased', station = ?, updated_at = ?, expires_at = ? "
+                           "WHERE device_id = ?", [(station, now, expires_at, device_id) for device_id in reused])
+
+            row = db.execute('SELECT next FROM sequences WHERE prefix = ?', (prefix,)).fetchone()
+            number = row[0] if row else max(int(start), 0)
+            fresh = []
+            while len(reused) + len(fresh) < count:
+                device_id = f"{prefix}{str(number).zfill(width)}"
+                cursor = db.execute("INSERT OR IGNORE INTO device_ids VALUES (?, ?, ?, 'leased', ?, ?, ?)",
+                                    (device_id, prefix, number, station, now, expires_at))
+                if cursor.rowcount:
+                    fresh.append(device_id)
+                number += 1
+            db.execute('INSERT INTO sequences VALUES (?, ?) ON CONFLICT(prefix) DO UPDATE SET next = excluded.next',
+                       (prefix, number))
+        return {'device_ids': reused + fresh, 'expires_at': expires_at}
+
+    def mark_used(self, device_ids, station=''):
+        """Record IDs as flashed (leased or typed in by hand) and move their sequence past them."""
+        now = time.time()
+        records, sequences = [], []
+        for device_id in device_ids:
+            match = _DEVICE_ID_NUMBER.match(device_id)
+            prefix, number = (match.group(1), int(match.group(2))) if match else (device_id, -1)
+            records.append((device_id, prefix, number, station, now))
+            if match:
+                sequences.append((prefix, number + 1))
+        if not records:
+            return
+        with self._transaction() as db:
+            db.executemany("INSERT INTO device_ids VALUES (?, ?, ?, 'used', ?, ?, NULL) ON CONFLICT(device_id) DO UPDATE "
+                           "SET state = 'used', station = excluded.station, updated_at = excluded.updated_at, expires_at = NULL",
+                           records)
+            db.executemany('INSERT INTO sequences VALUES (?, ?) ON CONFLICT(prefix) DO UPDATE '
+                           'SET next = max(next, excluded.next)', sequences)
+
+    def is_used(self, device_id):
+        with self._lock:
+            row = self._db().execute('SELECT state FROM device_ids WHERE device_id = ?', (device_id,)).fetchone()
+        return row is not None and row[0] == 'used'
+
+    def release(self, device_ids):
+        """Return unused leases so the numbers are reissued; used IDs are left alone."""
+        now = time.time()
+        with self._transaction() as db:
+            cursor = db.executemany("UPDATE device_ids SET state = 'returned', updated_at = ?, expires_at = NULL "
+                                    "WHERE device_id = ? AND state = 'leased'", [(now, d) for d in device_ids])
+            return cursor.rowcount
+
+    def status(self, prefix):
+        with self._lock:
+            db = self._db()
+            row = db.execute('SELECT next FROM sequences WHERE prefix = ?', (prefix,)).fetchone()
+            counts = dict(db.execute('SELECT state, count(*) FROM device_ids WHERE prefix = ? GROUP BY state', (prefix,)))
+        return {'prefix': prefix, 'next': row[0] if row else None, 'used': counts.get('used', 0),
+                'leased': counts.get('leased', 0), 'returned': counts.get('returned', 0)}
+
+id_allocator = DeviceIdAllocator()
+
+@app.route('/api/device-ids/reserve', methods=['POST'])
+def reserve_device_ids():
+    """Lease the next device IDs for a prefix: {prefix, count, width, start, station}."""
+    try:
+        data = request.get_json(silent=True) or request.form.to_dict()
+        prefix = (data.get('prefix') or '').strip()
+        if not prefix:
+            return jsonify({'error': 'prefix is required'}), 400
+        result = id_allocator.reserve(prefix, int(data.get('count', 1)), int(data.get('width', 4)),
+                                      int(data.get('start', 1)), str(data.get('station') or ''),
+                                      float(data.get('lease_seconds', DEVICE_ID_LEASE_SECONDS)))
+        return jsonify(result)
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': str(e)}), 400
+    except sqlite3.Error as e:
+        return jsonify({'error': f'Allocator error: {str(e)}'}), 503
+
+@app.route('/api/device-ids/return', methods=['POST'])
+def return_device_ids():
+    """Give back leased IDs that were never flashed: {device_ids: [...]}."""
+    data = request.get_json(silent=True) or {}
+    try:
+        return jsonify({'returned': id_allocator.release([str(d) for d in data.get('device_ids', [])])})
+    except sqlite3.Error as e:
+        return jsonify({'error': f'Allocator error: {str(e)}'}), 503
+
+@app.route('/api/device-ids/<path:prefix>')
+def device_id_status(prefix):
+    try:
+        return jsonify(id_allocator.status(prefix))
+    except sqlite3.Error as e:
+        return jsonify({'error': f'Allocator error: {str(e)}'}), 503
+
+# ---------- Provisioning Audit Log ----------
+
+# Append-only JSONL segments under data/audit/, one record per line. A SQLite index maps
+# device_id / time / firmware version to (segment, offset, length), so lookups are B-tree
+# seeks plus one pread per record. Requests only enqueue; a background thread appends,
+# indexes and rotates, so request handling never waits on disk.
+AUDIT_DIR = os.environ.get('AUDIT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'audit'))
+AUDIT_SEGMENT_BYTES = 64 * 1024 * 1024
+AUDIT_QUERY_LIMIT = 1000
+AUDIT_FLUSH_TIMEOUT = 10  # seconds the exit handler waits for queued records
+
+class AuditLog:
+    """Append-only provisioning log with an on-disk index."""
+
+    _ROTATE = object()
+
+    def __init__(self, directory=AUDIT_DIR, segment_bytes=AUDIT_SEGMENT_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = Lock()
+        self._segment = None  # (name, file object)
+        self._reader = None
+        self._reader_lock = Lock()
+
+    def record(self, event, **fields):
+        """Queue one record; empty fields are dropped to keep lines compact."""
+        entry = {'ts': round(time.time(), 3), 'event': event}
+        entry.update((k, v) for k, v in fields.items() if v not in (None, ''))
+        self._start()
+        if not self._thread.is_alive():
+            # Writer is gone (setup failed); keep the record in the console log rather than queueing forever
+            print(f"⚠️ Audit log unavailable, record not stored: {json.dumps(entry, ensure_ascii=False)}")
+            return
+        self.queue.put(entry)
+
+    def rotate(self):
+        """Close the current segment; the next record starts a new one."""
+        self._start()
+        self.queue.put(self._ROTATE)
+
+    def flush(self, timeout=AUDIT_FLUSH_TIMEOUT):
+        """Wait until everything queued so far is on disk and indexed; False if the
+        writer died or didn't catch up within `timeout` seconds."""
+        if self._thread is None:
+            return True
+        deadline = time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._thread.is_alive():
+                    print(f"⚠️ Audit log: {self.queue.unfinished_tasks} records not written")
+                    return False
+                self.queue.all_tasks_done.wait(min(remaining, 0.5))
+        return True
+
+    def _start(self):
+        if self._thread is None:
+            with self._thread_lock:
+                if self._thread is None:
+                    self._thread = Thread(target=self._run, name='audit-log', daemon=True)
+                    self._thread.start()
+
+    def _index_db(self):
+        os.makedirs(self.directory, exist_ok=True)
+        db = sqlite3.connect(os.path.join(self.directory, 'index.sqlite3'), timeout=10, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS records (
+                ts REAL NOT NULL, event TEXT NOT NULL, device_id TEXT, bot TEXT, firmware_version TEXT,
+                segment TEXT NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS records_device ON records (device_id, ts);
+            CREATE INDEX IF NOT EXISTS records_ts ON records (ts);
+            CREATE INDEX IF NOT EXISTS records_firmware ON records (firmware_version, ts);
+            CREATE INDEX IF NOT EXISTS records_segment ON records (segment, offset);
+        """)
+        return db
+
+    def _run(self):
+        try:
+            db = self._index_db()
+        except Exception as e:
+            print(f"⚠️ Audit log disabled: cannot open index in {self.directory}: {e}")
+            self._drain()
+            return
+        try:
+            self._recover(db)
         except Exception as e:
-            last_err = f"{' '.join(cmd)} raised {e}"
+            print(f"⚠️ Audit log recovery failed (unindexed records stay in their segments): {e}")
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < 500:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._append(db, batch)
+            except Exception as e:
+                print(f"⚠️ Audit log write failed: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _drain(self):
+        """Release records queued before the writer gave up, so flush() doesn't wait on them."""
+        while True:
+            try:
+                entry = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if entry is not self._ROTATE:
+                print(f"⚠️ Audit log unavailable, record not stored: {json.dumps(entry, ensure_ascii=False)}")
+            self.queue.task_done()
+
+    def _append(self, db, batch):
+        rows = []
+        for entry in batch:
+            if entry is self._ROTATE:
+                self._close_segment()
+                continue
+            line = json.dumps(entry, separators=(',', ':'), ensure_ascii=False).encode('utf-8') + b'\n'
+            name, f = self._open_segment()
+            offset = f.tell()
+            f.write(line)
+            rows.append((entry['ts'], entry['event'], entry.get('device_id'), entry.get('bot'),
+                         entry.get('firmware_version'), name, offset, len(line)))
+            if f.tell() >= self.segment_bytes:
+                self._close_segment()
+        if self._segment:
+            self._segment[1].flush()
+        with db:
+            db.executemany('INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
 
-    # If we get here, all methods failed
-    try: os.unlink(csv_path)
-    except: pass
-    raise RuntimeError(f"NVS generation failed. Details: {last_err}")
+    def _open_segment(self):
+        if self._segment is None:
+            name = f"audit-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.jsonl"
+            self._segment = (name, open(os.path.join(self.directory, name), 'ab'))
+        return self._segment
+
+    def _close_segment(self):
+        if self._segment:
+            self._segment[1].close()
+            self._segment = None
+
+    def _recover(self, db):
+        """Index lines that reached a segment but not the index (crash between the two writes)."""
+        for name in sorted(n for n in os.listdir(self.directory) if n.startswith('audit-') and n.endswith('.jsonl')):
+            path = os.path.join(self.directory, name)
+            end = db.execute('SELECT max(offset + length) FROM records WHERE segment = ?', (name,)).fetchone()[0] or 0
+            if os.path.getsize(path) <= end:
+                continue
+            rows = []
+            with open(path, 'rb') as f:
+                f.seek(end)
+                offset = end
+                for line in f:
+                    if line.endswith(b'\n'):
+                        try:
+                            entry = json.loads(line)
+                            rows.append((entry['ts'], entry['event'], entry.get('device_id'), entry.get('bot'),
+                                         entry.get('firmware_version'), name, offset, len(line)))
+                        except (ValueError, KeyError):
+                            pass
+                    offset += len(line)
+            with db:
+                db.executemany('INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            print(f"🧾 Audit log: re-indexed {len(rows)} records from {name}")
+
+    def query(self, device_id=None, since=None, until=None, firmware_version=None, limit=100):
+        """Newest-first records matching every given filter."""
+        where, params = [], []
+        for column, value in (('device_id', device_id), ('firmware_version', firmware_version)):
+            if value is not None:
+                where.append(f'{column} = ?')
+                params.append(value)
+        if since is not None:
+            where.append('ts >= ?')
+            params.append(since)
+        if until is not None:
+            where.append('ts < ?')
+            params.append(until)
+        sql = 'SELECT segment, offset, length FROM records'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY ts DESC LIMIT ?'
+        params.append(min(int(limit), AUDIT_QUERY_LIMIT))
+        with self._reader_lock:
+            if self._reader is None:
+                self._reader = self._index_db()
+            locations = self._reader.execute(sql, params).fetchall()
+
+        records, files = [], {}
+        try:
+            for segment, offset, length in locations:
+                if segment not in files:
+                    files[segment] = os.open(os.path.join(self.directory, segment), os.O_RDONLY)
+                records.append(json.loads(os.pread(files[segment], length, offset)))
+        finally:
+            for fd in files.values():
+                os.close(fd)
+        return records
+
+audit_log = AuditLog()
+atexit.register(audit_log.flush)
+
+def _audit_time(value):
+    """Epoch seconds or ISO-8601 timestamp → epoch seconds."""
+    if value in (None, ''):
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+@app.route('/api/audit')
+def audit_query():
+    """Look up provisioning records by device_id, firmware_version and/or since/until."""
+    try:
+        records = audit_log.query(device_id=request.args.get('device_id') or None,
+                                  since=_audit_time(request.args.get('since')),
+                                  until=_audit_time(request.args.get('until')),
+                                  firmware_version=request.args.get('firmware_version') or None,
+                                  limit=request.args.get('limit', 100))
+        return jsonify({'records': records, 'count': len(records)})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except (OSError, sqlite3.Error) as e:
+        return jsonify({'error': f'Audit lookup failed: {str(e)}'}), 500
+
+@app.route('/api/audit/rotate', methods=['POST'])
+def audit_rotate():
+    audit_log.rotate()
+    return jsonify({'success': True})
+
+def _audit_firmware(bot_name):
+    """Firmware fields for an audit record: what a robot of this bot gets flashed with."""
+    manager = firmware_managers.get(bot_name)
+    if not manager:
+        return {'bot': bot_name}
+    return {'bot': bot_name, 'firmware_version': manager.current_version, 'firmware_sha256': manager.current_hash}
+
+# ---------- NVS Result Cache ----------
+
+# Partitions are deterministic, so they're stored under a hash of everything that
+# shapes the bytes: generator version, canonical CSV rows, size and (when encrypting)
+# the key fingerprint. The hash doubles as the strong ETag.
+try:
+    NVS_GENERATOR_VERSION = f"{importlib.metadata.version('esp-idf-nvs-partition-gen')}+bonicbot.1"
+except importlib.metadata.PackageNotFoundError:
+    NVS_GENERATOR_VERSION = 'unknown+bonicbot.1'
+NVS_CACHE_DIR = os.environ.get('NVS_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'nvs'))
+NVS_CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+NVS_CACHE_DISK_BYTES = 512 * 1024 * 1024
+
+def nvs_cache_key(csv_rows, size=NVS_PARTITION_SIZE, key=None):
+    canonical = json.dumps([NVS_GENERATOR_VERSION, size, [[str(c) for c in row] for row in csv_rows],
+                            hashlib.sha256(key).hexdigest() if key else None],
+                           separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+class NvsResultCache:
+    """Memory LRU in front of a size-bounded disk LRU (mtime = last use)."""
+
+    def __init__(self, directory=NVS_CACHE_DIR, memory_bytes=NVS_CACHE_MEMORY_BYTES, disk_bytes=NVS_CACHE_DISK_BYTES):
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.memory = LruCache(max_items=1 << 20, max_bytes=memory_bytes)
+        self._disk = None  # {digest: size}, oldest first; scanned on first use
+        self._disk_size = 0
+        self._lock = Lock()
+        self.hits = {'memory': 0, 'disk': 0, 'miss': 0}
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest + '.bin')
+
+    def _disk_index(self):
+        if self._disk is None:
+            found = []
+            if os.path.isdir(self.directory):
+                for sub in os.scandir(self.directory):
+                    if sub.is_dir():
+                        for entry in os.scandir(sub.path):
+                            if entry.name.endswith('.bin'):
+                                st = entry.stat()
+                                found.append((st.st_mtime, entry.name[:-4], st.st_size))
+            found.sort()
+            self._disk = OrderedDict((digest, size) for _, digest, size in found)
+            self._disk_size = sum(self._disk.values())
+        return self._disk
+
+    def get(self, digest):
+        data = self.memory.get(digest)
+        if data is not None:
+            self.hits['memory'] += 1
+            return data
+        with self._lock:
+            if digest not in self._disk_index():
+                self.hits['miss'] += 1
+                return None
+            self._disk.move_to_end(digest)
+        try:
+            path = self._path(digest)
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._disk_size -= self._disk.pop(digest, 0)
+            self.hits['miss'] += 1
+            return None
+        self.hits['disk'] += 1
+        self.memory.put(digest, data)
+        return data
+
+    def put(self, digest, data):
+        data = bytes(data)
+        self.memory.put(digest, data)
+        path = self._path(digest)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"⚠️ NVS cache write failed: {e}")
+            return data
+        with self._lock:
+            index = self._disk_index()
+            self._disk_size += len(data) - index.pop(digest, 0)
+            index[digest] = len(data)
+            while self._disk_size > self.disk_bytes and len(index) > 1:
+                old, old_size = index.popitem(last=False)
+                self._disk_size -= old_size
+                try: os.unlink(self._path(old))
+                except OSError: pass
+        return data
+
+    def stats(self):
+        with self._lock:
+            self._disk_index()
+            return {'memory_entries': len(self.memory), 'memory_bytes': self.memory.size,
+                    'disk_entries': len(self._disk), 'disk_bytes': self._disk_size, 'hits': dict(self.hits)}
+
+nvs_cache = NvsResultCache()
+
+def _device_nvs_rows(device_id, robot_model='', left_motor_scale='1000', right_motor_scale='1000'):
+    """Build the NVS CSV rows for one robot."""
+    csv_content = [
+        ['key', 'type', 'encoding', 'value'],
+        ['bonicbot', 'namespace', '', ''],
+        ['device_id', 'data', 'string', device_id]
+    ]
+    if robot_model:
+        csv_content.append(['robot_model', 'data', 'string', robot_model])
+
+        # Calibration for S1 Lite
+        if robot_model.lower() == 's1 lite':
+            # NVS keys are strictly limited to 15 characters by ESP-IDF.
+            # Truncating "left_motor_scale" -> "left_motor_scal"
+            # Truncating "right_motor_scale" -> "right_motor_sca"
+            csv_content.append(['left_motor_scale'[:15], 'data', 'i16', left_motor_scale])
+            csv_content.append(['right_motor_scale'[:15], 'data', 'i16', right_motor_scale])
+    return csv_content
+
+def _form_flag(form, name):
+    return (form.get(name) or '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+def _cached_nvs(csv_rows, size=NVS_PARTITION_SIZE, key=None, digest=None):
+    """(content hash, partition bytes), built and encrypted only on a cache miss."""
+    digest = digest or nvs_cache_key(csv_rows, size, key)
+    nvs_data = nvs_cache.get(digest)
+    if nvs_data is None:
+        nvs_data = _render_nvs(csv_rows, size)
+        if key:
+            nvs_data = _crypt_nvs_image(nvs_data, key)
+        nvs_data = nvs_cache.put(digest, nvs_data)
+    return digest, nvs_data
+
+def _device_nvs_image(device_id, robot_model='', left_motor_scale='1000', right_motor_scale='1000',
+                      encrypt=False, size=NVS_PARTITION_SIZE):
+    rows = _device_nvs_rows(device_id, robot_model, left_motor_scale, right_motor_scale)
+    return _cached_nvs(rows, size, _nvs_key_for(device_id) if encrypt else None)
 
 @app.route('/generate-single', methods=['POST'])
 def generate_single():
-    """Generate single NVS binary file and send it as attachment."""
+    """Generate single NVS binary file and send it as attachment (cached, ETag/304).
+    With encrypt=1 and per-device keys the image is useless without its key partition,
+    so both come back in a ZIP named like the batch output."""
     try:
         device_id = (request.form.get('device_id') or '').strip()
         robot_model = (request.form.get('robot_model') or '').strip()
         left_motor_scale = request.form.get('left_motor_scale', '1000')
         right_motor_scale = request.form.get('right_motor_scale', '1000')
+        encrypt = _form_flag(request.form, 'encrypt')
+        station = (request.form.get('station') or '').strip()
 
+        if not device_id and (request.form.get('prefix') or '').strip():
+            # Let the server pick the next free ID for this prefix
+            try:
+                device_id = id_allocator.reserve(request.form['prefix'].strip(), 1, int(request.form.get('width', 4)),
+                                                 station=station)['device_ids'][0]
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            except sqlite3.Error as e:
+                return jsonify({'error': f'Allocator error: {str(e)}'}), 503
         if not device_id:
             return jsonify({'error': 'Device ID is required'}), 400
 
-        csv_content = [
-            ['key', 'type', 'encoding', 'value'],
-            ['bonicbot', 'namespace', '', ''],
-            ['device_id', 'data', 'string', device_id]
-        ]
-        if robot_model:
-            csv_content.append(['robot_model', 'data', 'string', robot_model])
-            
-            # Calibration for S1 Lite
-            if robot_model.lower() == 's1 lite':
-                # NVS keys are strictly limited to 15 characters by ESP-IDF.
-                # Truncating "left_motor_scale" -> "left_motor_scal"
-                # Truncating "right_motor_scale" -> "right_motor_sca"
-                csv_content.append(['left_motor_scale'[:15], 'data', 'i16', left_motor_scale])
-                csv_content.append(['right_motor_scale'[:15], 'data', 'i16', right_motor_scale])
-
-        bin_path = _generate_nvs_bin(csv_content)
-
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f'{device_id}_nvs_{timestamp}.bin'
-        return send_file(bin_path, as_attachment=True, download_name=filename, mimetype='application/octet-stream')
+        csv_content = _device_nvs_rows(device_id, robot_model, left_motor_scale, right_motor_scale)
+        key = _nvs_key_for(device_id) if encrypt else None
+        digest = nvs_cache_key(csv_content, NVS_PARTITION_SIZE, key)
+        headers = {'ETag': f'"{digest}"', 'Cache-Control': 'private, no-cache'}
+        audit_fields = dict(device_id=device_id, robot_model=robot_model, left_motor_scale=left_motor_scale,
+                            right_motor_scale=right_motor_scale, encrypted=encrypt or None, station=station,
+                            **_audit_firmware((request.form.get('bot') or '').strip()))
+        if request.if_none_match.contains(digest):
+            # Still a robot being provisioned, but the image is never loaded: record it by cache key
+            if not id_allocator.is_used(device_id):
+                id_allocator.mark_used([device_id], station)
+            audit_log.record('nvs', **audit_fields, nvs_cache_key=digest, not_modified=True)
+            return Response(status=304, headers=headers)
+
+        digest, nvs_data = _cached_nvs(csv_content, NVS_PARTITION_SIZE, key, digest)
+        id_allocator.mark_used([device_id], station)
+        audit_log.record('nvs', **audit_fields, nvs_sha256=hashlib.sha256(nvs_data).hexdigest())
+        if encrypt and _nvs_per_device_keys():
+            archive = io.BytesIO()
+            with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+                zf.writestr(f"{device_id}_nvs.bin", nvs_data)
+                zf.writestr(f"{device_id}_nvs_keys.bin", device_key_partition(device_id))
+            archive.seek(0)
+            response = send_file(archive, as_attachment=True, download_name=f'{device_id}_nvs_{digest[:8]}.zip',
+                                 mimetype='application/zip', etag=digest, conditional=False)
+        else:
+            response = send_file(io.BytesIO(nvs_data), as_attachment=True, download_name=f'{device_id}_nvs_{digest[:8]}.bin',
+                                 mimetype='application/octet-stream', etag=digest, conditional=False)
+        response.headers['Cache-Control'] = headers['Cache-Control']
+        response.headers['X-Device-Id'] = quote(device_id)
+        return response
     except Exception as e:
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
+# ---------- Bulk NVS Provisioning ----------
+
+MAX_BATCH_DEVICES = 5000
+NVS_POOL_WORKERS = os.cpu_count() or 1
+_nvs_pool = None
+_nvs_pool_lock = Lock()
+_in_nvs_pool_worker = False
+
+def _mark_nvs_pool_worker():
+    global _in_nvs_pool_worker
+    _in_nvs_pool_worker = True
+
+def _get_nvs_pool():
+    """Lazily start the shared process pool (one worker per core).
+
+    The pool is created from a request thread of a threaded server, so workers come from a
+    forkserver (spawn where unavailable) instead of a fork that could copy held locks."""
+    global _nvs_pool
+    with _nvs_pool_lock:
+        if _nvs_pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _nvs_pool = ProcessPoolExecutor(max_workers=NVS_POOL_WORKERS, initializer=_mark_nvs_pool_worker,
+                                            mp_context=multiprocessing.get_context(method))
+        return _nvs_pool
+
+def _generate_device_nvs(device):
+    """Process-pool worker: returns (device_id, {zip name: bytes}, error)."""
+    device_id = device['device_id']
+    try:
+        rows = _device_nvs_rows(device_id, device.get('robot_model', ''),
+                                device.get('left_motor_scale', '1000'), device.get('right_motor_scale', '1000'))
+        files = {f"{device_id}_nvs.bin": _render_nvs(rows)}
+        if device.get('encrypt'):
+            if _nvs_per_device_keys():
+                xts_key = derive_device_keys(device_id)[1]
+                files[f"{device_id}_nvs_keys.bin"] = device_key_partition(device_id)
+            else:
+                xts_key = _load_nvs_key()
+            files[f"{device_id}_nvs.bin"] = bytes(_crypt_nvs_image(files[f"{device_id}_nvs.bin"], xts_key))
+        return device_id, files, None
+    except Exception as e:
+        return device_id, None, str(e)
+
+def _device_id_range(prefix, start, end):
+    """Expand prefix+start..end using the same zero-padding as predictNextId in the UI:
+    numbers are padded to the digit count of `start`, and never truncated."""
+    if not (start.isdigit() and end.isdigit()):
+        raise ValueError('Range start and end must be numbers')
+    width = len(start)
+    first, last = int(start), int(end)
+    if last < first:
+        raise ValueError('Range end must not be below range start')
+    if last - first + 1 > MAX_BATCH_DEVICES:
+        raise ValueError(f'Batch is limited to {MAX_BATCH_DEVICES} devices')
+    return [f"{prefix}{str(n).zfill(width)}" for n in range(first, last + 1)]
+
+def _parse_batch_devices(form, files):
+    """Collect device dicts from an uploaded CSV or a prefix/start/end range."""
+    defaults = {
+        'encrypt': _form_flag(form, 'encrypt'),
+        'bot': (form.get('bot') or '').strip(),
+        'station': (form.get('station') or '').strip(),
+        'robot_model': (form.get('robot_model') or '').strip(),
+        'left_motor_scale': form.get('left_motor_scale', '1000'),
+        'right_motor_scale': form.get('right_motor_scale', '1000'),
+    }
+    device_fields = ('device_id', 'robot_model', 'left_motor_scale', 'right_motor_scale')
+    devices = []
+    upload = files.get('devices')
+    if upload and upload.filename:
+        text = upload.read().decode('utf-8-sig')
+        reader = csv.DictReader(line for line in io.StringIO(text) if not line.startswith('#'))
+        for row in reader:
+            row = {k.strip(): (v or '').strip() for k, v in row.items() if k}
+            if not row.get('device_id'):
+                continue
+            devices.append({**defaults, **{k: row[k] for k in device_fields if row.get(k)}})
+            if len(devices) > MAX_BATCH_DEVICES:
+                raise ValueError(f'Batch is limited to {MAX_BATCH_DEVICES} devices')
+    elif (form.get('count') or '').strip():
+        # Server-allocated IDs; leases that never get generated are returned afterwards
+        prefix = (form.get('prefix') or '').strip()
+        reserved = id_allocator.reserve(prefix, int(form['count']), int(form.get('width', 4)),
+                                      station=(form.get('station') or '').strip())
+        devices = [{**defaults, 'device_id': device_id, 'allocated': True} for device_id in reserved['device_ids']]
+    else:
+        prefix = (form.get('prefix') or '').strip()
+        start = (form.get('start') or '').strip()
+        end = (form.get('end') or '').strip()
+        if not (start and end):
+            raise ValueError('Upload a devices CSV, give prefix and count, or give prefix, start and end')
+        devices = [{**defaults, 'device_id': device_id} for device_id in _device_id_range(prefix, start, end)]
+
+    if not devices:
+        raise ValueError('No devices to generate')
+    seen = set()
+    for device in devices:
+        if device['device_id'] in seen:
+            raise ValueError(f"Duplicate device ID: {device['device_id']}")
+        seen.add(device['device_id'])
+    return devices
+
+def _preflight_batch(devices):
+    """Reject a batch up front if any robot's rows won't fit the partition."""
+    for device in devices:
+        rows = _device_nvs_rows(device['device_id'], device.get('robot_model', ''),
+                                device.get('left_motor_scale', '1000'), device.get('right_motor_scale', '1000'))
+        try:
+            plan = plan_nvs(rows)
+        except ValueError as e:
+            raise ValueError(f"{device['device_id']}: {e}")
+        if not plan['fits']:
+            raise ValueError(f"{device['device_id']}: needs {plan['pages']} NVS pages, "
+                             f"partition has {plan['max_pages']} (min size {hex(plan['min_size'])})")
+
+class _ZipStream:
+    """Write-only, non-seekable sink for zipfile; drain() hands out what was written so far."""
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def _stream_batch_zip(devices):
+    """Fan generation out over the process pool and yield ZIP bytes as each device finishes.
+    At most a few results per worker are in flight, so memory stays flat for any batch size."""
+    pool = _get_nvs_pool()
+    window = 2 * NVS_POOL_WORKERS
+    sink = _ZipStream()
+    errors = []
+    generated = []
+    pending = {}  # future -> device
+    remaining = iter(devices)
+
+    try:
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+            while True:
+                for device in remaining:
+                    pending[pool.submit(_generate_device_nvs, device)] = device
+                    if len(pending) >= window:
+                        break
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    device = pending.pop(future)
+                    device_id, files, error = future.result()
+                    if error:
+                        errors.append(f"{device_id}: {error}")
+                        continue
+                    for name, data in files.items():
+                        zf.writestr(name, data)
+                    generated.append(device_id)
+                    audit_log.record('nvs_batch', device_id=device_id, robot_model=device.get('robot_model'),
+                                     left_motor_scale=device.get('left_motor_scale'),
+                                     right_motor_scale=device.get('right_motor_scale'),
+                                     encrypted=device['encrypt'] or None, station=device['station'],
+                                     nvs_sha256=hashlib.sha256(files[f"{device_id}_nvs.bin"]).hexdigest(),
+                                     **_audit_firmware(device['bot']))
+                yield sink.drain()
+            if errors:
+                zf.writestr('errors.txt', '\n'.join(errors) + '\n')
+        yield sink.drain()
+    finally:
+        # Also runs when the client disconnects mid-download (GeneratorExit at a yield):
+        # stop queued work, keep IDs whose images were produced, return the rest
+        for future in pending:
+            future.cancel()
+        id_allocator.mark_used(generated)
+        produced = set(generated)
+        id_allocator.release([d['device_id'] for d in devices if d.get('allocated') and d['device_id'] not in produced])
+
+@app.route('/generate-batch', methods=['POST'])
+def generate_batch():
+    """Generate NVS binaries for many robots and stream them back as a ZIP."""
+    devices = []
+    try:
+        devices = _parse_batch_devices(request.form, request.files)
+        _preflight_batch(devices)
+        if devices[0]['encrypt']:
+            _nvs_key_for(devices[0]['device_id'])  # fail fast before streaming starts
+    except (ValueError, OSError) as e:
+        id_allocator.release([d['device_id'] for d in devices if d.get('allocated')])
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        id_allocator.release([d['device_id'] for d in devices if d.get('allocated')])
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    filename = f'nvs_batch_{len(devices)}_{timestamp}.zip'
+    print(f"📦 Generating NVS batch of {len(devices)} devices")
+    return Response(_stream_batch_zip(devices), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+def _stream_key_zip(device_ids, chunk_size=256):
+    """ZIP of <device_id>_nvs_keys.bin, derived a chunk of devices at a time."""
+    master = _load_nvs_hmac_key()
+    sink = _ZipStream()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for start in range(0, len(device_ids), chunk_size):
+            for device_id, partition in nvs_key_partitions(device_ids[start:start + chunk_size], master).items():
+                zf.writestr(f"{device_id}_nvs_keys.bin", partition)
+            yield sink.drain()
+    yield sink.drain()
+
+@app.route('/api/nvs/keys', methods=['POST'])
+def generate_nvs_keys():
+    """Per-device NVS key partitions for a CSV or ID range (same inputs as /generate-batch)."""
+    try:
+        device_ids = [d['device_id'] for d in _parse_batch_devices(request.form, request.files)]
+        _load_nvs_hmac_key()
+    except (ValueError, OSError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    return Response(_stream_key_zip(device_ids), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename=nvs_keys_{len(device_ids)}_{timestamp}.zip'})
+
+# ---------- One-shot Provisioning ----------
+
+# One esp-web-tools session per robot: bootloader, partition table, per-device NVS and app,
+# either as separate parts or as a single merged image (same layout as `esptool merge_bin`).
+BOOTLOADER_OFFSET = 0x0
+PARTITION_TABLE_OFFSET = 0x8000
+APP_OFFSET = 0x10000
+PROVISION_CHIP_FAMILY = 'ESP32-S3'
+_PARTITION_ENTRY = struct.Struct('<HBBII16sI')  # magic, type, subtype, offset, size, label, flags
+_PARTITION_MAGIC = 0x50AA
+_provision_bases = LruCache(2 * len(FIRMWARE_REPOS))
+
+def read_partition_table(data):
+    """Parse a binary ESP partition table into [{'label', 'type', 'subtype', 'offset', 'size'}]."""
+    partitions = []
+    for pos in range(0, len(data) - 31, 32):
+        magic, type_, subtype, offset, size, label, _ = _PARTITION_ENTRY.unpack_from(data, pos)
+        if magic != _PARTITION_MAGIC:
+            break  # MD5 entry or erased tail
+        partitions.append({'label': label.rstrip(b'\0').decode('ascii', 'replace'), 'type': type_,
+                           'subtype': subtype, 'offset': offset, 'size': size})
+    return partitions
+
+def _static_file(url_path):
+    return os.path.join(app.static_folder, url_path.split('?', 1)[0][len('/static/'):])
+
+class ProvisionBase:
+    """Merged flash image for one bot, precomputed once, with holes for the per-device
+    partitions. Streaming yields the cached segments and the device bytes without copying."""
+
+    def __init__(self, manager, with_keys=False):
+        self.boot_urls = manager.boot_files()
+        with open(_static_file(self.boot_urls[0]), 'rb') as f:
+            bootloader = f.read()
+        with open(_static_file(self.boot_urls[1]), 'rb') as f:
+            table = f.read()
+        with open(manager.firmware_path, 'rb') as f:
+            firmware = f.read()
+
+        partitions = read_partition_table(table)
+        nvs = next((p for p in partitions if p['type'] == 1 and p['subtype'] == 2), None)
+        keys = next((p for p in partitions if p['type'] == 1 and p['subtype'] == 4), None)
+        if not nvs:
+            raise ValueError(f'{manager.bot_name}: partition table has no nvs partition')
+        if with_keys and not keys:
+            raise ValueError(f'{manager.bot_name}: partition table has no nvs_keys partition for encrypted NVS')
+        self.nvs_offset, self.nvs_size = nvs['offset'], nvs['size']
+        self.keys_offset = keys['offset'] if with_keys else None
+
+        parts = [(BOOTLOADER_OFFSET, bootloader), (PARTITION_TABLE_OFFSET, table),
+                 (nvs['offset'], ('nvs', nvs['size'])), (APP_OFFSET, firmware)]
+        if with_keys:
+            parts.append((keys['offset'], ('keys', keys['size'])))
+        self.segments = []
+        pending = bytearray()
+        cursor = 0
+        for offset, part in sorted(parts, key=lambda p: p[0]):
+            if offset < cursor:
+                raise ValueError(f'{manager.bot_name}: image part at {hex(offset)} overlaps the previous one')
+            pending += b'\xff' * (offset - cursor)
+            if isinstance(part, tuple):
+                self.segments += [bytes(pending), part]
+                pending = bytearray()
+                cursor = offset + part[1]
+            else:
+                pending += part
+                cursor = offset + len(part)
+        self.segments.append(bytes(pending))
+        self.length = cursor
+
+        digest = hashlib.sha256()
+        for segment in self.segments:
+            digest.update(segment if isinstance(segment, bytes) else repr(segment).encode())
+        self.digest = digest.hexdigest()
+
+    def stream(self, slots):
+        """Yield the merged image with slots {'nvs': bytes, 'keys': bytes} filled in (0xFF-padded)."""
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                if segment:
+                    yield segment
+                continue
+            name, size = segment
+            data = slots[name]
+            if len(data) > size:
+                raise ValueError(f'{name} image ({len(data)} bytes) exceeds its {size}-byte partition')
+            yield bytes(data)
+            if len(data) < size:
+                yield b'\xff' * (size - len(data))
+
+def _provision_base(manager, with_keys=False):
+    """Cached ProvisionBase, rebuilt whenever the app, bootloader or partition table changes."""
+    files = [manager.firmware_path] + [_static_file(url) for url in manager.boot_files()]
+    signature = tuple((st.st_ino, st.st_size, st.st_mtime_ns) for st in map(os.stat, files))
+    cache_key = (manager.bot_name, with_keys, signature)
+    base = _provision_bases.get(cache_key)
+    if base is None:
+        base = ProvisionBase(manager, with_keys)
+        _provision_bases.put(cache_key, base)
+    return base
+
+def _provision_request(bot_name):
+    """(manager, device args) for a provisioning route; raises LookupError for unknown bots."""
+    if bot_name not in firmware_managers:
+        raise LookupError(f'Invalid bot name: {bot_name}')
+    manager = firmware_managers[bot_name]
+    if not os.path.exists(manager.firmware_path):
+        raise LookupError(f'No local firmware for {bot_name}')
+    args = {
+        'robot_model': (request.args.get('robot_model') or '').strip(),
+        'left_motor_scale': request.args.get('left_motor_scale', '1000'),
+        'right_motor_scale': request.args.get('right_motor_scale', '1000'),
+        'encrypt': _form_flag(request.args, 'encrypt'),
+    }
+    return manager, args
+
+def _provision_slots(device_id, base, args):
+    """Per-device partition images for a base: NVS sized to the partition table, plus keys."""
+    digest, nvs_data = _device_nvs_image(device_id, args['robot_model'], args['left_motor_scale'],
+                                         args['right_motor_scale'], args['encrypt'], base.nvs_size)
+    slots = {'nvs': nvs_data}
+    if args['encrypt']:
+        slots['keys'] = device_key_partition(device_id) if _nvs_per_device_keys() else nvs_key_partition(_load_nvs_key())
+        digest += hashlib.sha256(slots['keys']).hexdigest()
+    return digest, slots
+
+@app.route('/api/provision/<bot_name>/<device_id>/manifest')
+def provision_manifest(bot_name, device_id):
+    """esp-web-tools manifest that installs firmware and this robot's NVS in one session."""
+    try:
+        manager, args = _provision_request(bot_name)
+        base = _provision_base(manager, args['encrypt'])
+        query = {k: v for k, v in args.items() if v and k != 'encrypt'}
+        if args['encrypt']:
+            query['encrypt'] = '1'
+        # Hash-keyed URLs so the browser never reuses another firmware's or robot's bytes
+        digest, _ = _provision_slots(device_id, base, args)
+        query['h'] = hashlib.sha256((base.digest + digest).encode()).hexdigest()[:16]
+        prefix = f"/api/provision/{quote(bot_name, safe='')}/{quote(device_id, safe='')}"
+        suffix = '?' + urlencode(query)
+
+        if _form_flag(request.args, 'merged'):
+            parts = [{"path": f"{prefix}/merged.bin{suffix}", "offset": 0}]
+        else:
+            v_slug = (manager.current_version or "unknown").replace(" ", "_")
+            parts = [
+                {"path": base.boot_urls[0], "offset": BOOTLOADER_OFFSET},
+                {"path": base.boot_urls[1], "offset": PARTITION_TABLE_OFFSET},
+                {"path": f"{prefix}/nvs.bin{suffix}", "offset": base.nvs_offset},
+                {"path": f"/static/{bot_name}/{manager.asset_name}?v={v_slug}", "offset": APP_OFFSET,
+                 **manager.digest_fields()},
+            ]
+            if args['encrypt']:
+                parts.append({"path": f"{prefix}/nvs_keys.bin{suffix}", "offset": base.keys_offset})
+            parts.sort(key=lambda part: part['offset'])
+
+        return jsonify({
+            "name": f"{bot_name} {device_id}",
+            "version": manager.current_version or "Unknown",
+            "new_install_prompt_erase": True,
+            "builds": [{"chipFamily": PROVISION_CHIP_FAMILY, "parts": parts}]
+        })
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    except (ValueError, OSError) as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/provision/<bot_name>/<device_id>/nvs.bin')
+@app.route('/api/provision/<bot_name>/<device_id>/nvs_keys.bin')
+@app.route('/api/provision/<bot_name>/<device_id>/merged.bin')
+def provision_image(bot_name, device_id):
+    """Per-device NVS / key partition, or the merged image streamed from the cached base."""
+    try:
+        manager, args = _provision_request(bot_name)
+        part = request.path.rsplit('/', 1)[1]
+        if part == 'nvs_keys.bin' and not args['encrypt']:
+            return jsonify({'error': 'Key partition is only used with encrypt=1'}), 400
+        base = _provision_base(manager, args['encrypt'])
+        digest, slots = _provision_slots(device_id, base, args)
+        if part == 'merged.bin':
+            etag = hashlib.sha256((base.digest + digest).encode()).hexdigest()
+        else:
+            etag = hashlib.sha256((part + digest).encode()).hexdigest()
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': 'private, no-cache'}
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+
+        if part != 'nvs_keys.bin':
+            audit_log.record('provision', device_id=device_id, image=part, robot_model=args['robot_model'],
+                             left_motor_scale=args['left_motor_scale'], right_motor_scale=args['right_motor_scale'],
+                             encrypted=args['encrypt'] or None, nvs_sha256=hashlib.sha256(slots['nvs']).hexdigest(),
+                             station=(request.args.get('station') or '').strip(), **_audit_firmware(bot_name))
+        if part == 'merged.bin':
+            headers['Content-Length'] = str(base.length)
+            body = base.stream(slots)
+        else:
+            body = slots['keys' if part == 'nvs_keys.bin' else 'nvs']
+        return Response(body, mimetype='application/octet-stream', headers=headers)
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    except (ValueError, OSError) as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/nvs/plan', methods=['POST'])
+def nvs_plan():
+    """Sizing preflight: JSON {rows, size, version}, a CSV upload, or single-robot form fields."""
+    try:
+        payload = request.get_json(silent=True) or {}
+        params = {**request.form.to_dict(), **payload}
+        size = params.get('size', NVS_PARTITION_SIZE)
+        size = int(size, 0) if isinstance(size, str) else int(size)
+        version = int(params.get('version', NVS_VERSION))
+        if version not in (nvs_gen.Page.VERSION1, nvs_gen.Page.VERSION2, 1, 2):
+            raise ValueError('version must be 1 or 2')
+        version = {1: nvs_gen.Page.VERSION1, 2: nvs_gen.Page.VERSION2}.get(version, version)
+
+        upload = request.files.get('file')
+        if upload and upload.filename:
+            rows = [row for row in csv.reader(io.StringIO(upload.read().decode('utf-8-sig'))) if row]
+        elif payload.get('rows'):
+            rows = [[str(c) for c in row] for row in payload['rows']]
+            if rows[0][:1] != ['key']:
+                rows.insert(0, ['key', 'type', 'encoding', 'value'])
+        elif (params.get('device_id') or '').strip():
+            rows = _device_nvs_rows(params['device_id'].strip(), (params.get('robot_model') or '').strip(),
+                                    str(params.get('left_motor_scale', '1000')), str(params.get('right_motor_scale', '1000')))
+        else:
+            return jsonify({'error': 'Send rows, a CSV file, or device_id'}), 400
+        return jsonify(plan_nvs(rows, size, version))
+    except (ValueError, TypeError, KeyError, IndexError) as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/nvs/inspect', methods=['POST'])
+def inspect_nvs():
+    """Parse an uploaded NVS .bin; optionally diff it against a second upload ('compare')."""
+    try:
+        upload = request.files.get('file')
+        if not upload:
+            return jsonify({'error': 'NVS file is required'}), 400
+        # Encrypted dumps: upload the key partition as 'key', or decrypt=1 for the station key
+        key_upload = request.files.get('key')
+        key = None
+        if key_upload:
+            key = _parse_nvs_key(key_upload.read(), 'key upload')
+        elif _form_flag(request.form, 'decrypt'):
+            key = _load_nvs_key()
+
+        def load(file_storage):
+            data = file_storage.read()
+            if key is not None:
+                data = _crypt_nvs_image(data, key, decrypt=True)
+            return NvsImage(data, name=file_storage.filename)
+
+        image = load(upload)
+        result = image.summary()
+
+        other = request.files.get('compare')
+        if other:
+            result['diff'] = nvs_diff(image, load(other))
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({'error': f'Inspection failed: {str(e)}'}), 500
+
 @app.route('/api/validate-tools')
 def validate_tools():
     """Check if required tools are available on the server."""
-    tools_status = {}
+    tools_status = {'nvs_generator_inprocess': hasattr(nvs_gen, 'nvs_open')}
+    try:
+        tools_status['nvs_encryption_key'] = bool(_load_nvs_key())
+    except (ValueError, OSError):
+        tools_status['nvs_encryption_key'] = False
+    tools_status['nvs_per_device_keys'] = _nvs_per_device_keys()
+    tools_status['nvs_cache'] = nvs_cache.stats()
     methods = [
         ('esp_idf_nvs_partition_gen', ['python3', '-m', 'esp_idf_nvs_partition_gen.nvs_partition_gen', '--help']),
         ('esp_idf_nvs_partition_gen_py', ['python', '-m', 'esp_idf_nvs_partition_gen.nvs_partition_gen', '--help']),
@@ -658,8 +3903,13 @@ def validate_tools():
     return jsonify(tools_status)
 
 if __name__ == '__main__':
-    # Initialize firmware managers
-    initialize_firmware_managers()
+    debug = True
+    # With the reloader this block runs in the file watcher too; only the serving child
+    # (WERKZEUG_RUN_MAIN=true) owns the firmware store and downloads.
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        # Initialize firmware managers
+        initialize_firmware_managers()
+        firmware_prefetcher.start()
     
     print("🤖 BonicBot NVS Generator (Enhanced Firmware Management)")
     print("📊 UI: http://localhost:8001")
@@ -671,4 +3921,4 @@ if __name__ == '__main__':
         print(f"     POST /api/firmware/{bot_name}/check-update - Check for updates")
         print(f"     POST /api/firmware/{bot_name}/download - Download latest firmware")
     
-    app.run(host='0.0.0.0', port=8001,ssl_context=('/home/pi/certs/raspberrypi.crt', '/home/pi/certs/raspberrypi.key'), debug=True)
+    app.run(host='0.0.0.0', port=8001,ssl_context=('/home/pi/certs/raspberrypi.crt', '/home/pi/certs/raspberrypi.key'), debug=debug)
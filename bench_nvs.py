@@ -0,0 +1,125 @@
+"""
+NVS generation benchmark.
+
+Compares the in-process generator and the template-and-patch path used by
+/generate-single against the old subprocess path (temp CSV +
+`python -m esp_idf_nvs_partition_gen.nvs_partition_gen`).
+
+Byte-identity of the template path with a full rebuild is covered by
+tests/test_nvs_template.py; this script only times.
+
+`writer` mode times NvsWriter against the nvs_partition_gen reference classes on
+large synthetic partitions (u32 keys, strings and multi-page blobs).
+
+Usage:
+    python bench_nvs.py [iterations]
+    python bench_nvs.py writer [entries ...]      (default: 100 10000 100000)
+"""
+import csv
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from app import _generate_nvs_bytes, _render_nvs, _device_nvs_rows, NVS_PARTITION_SIZE
+
+SAMPLE_ROWS = [
+    ['key', 'type', 'encoding', 'value'],
+    ['bonicbot', 'namespace', '', ''],
+    ['device_id', 'data', 'string', 'BonicBotS1-0153'],
+    ['robot_model', 'data', 'string', 'S1 Lite'],
+    ['left_motor_scal', 'data', 'i16', '980'],
+    ['right_motor_sca', 'data', 'i16', '1015'],
+]
+
+
+def generate_subprocess(csv_rows, size=NVS_PARTITION_SIZE):
+    """The pre-engine implementation: temp CSV in, CLI run, .bin read back."""
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.csv', delete=False) as csv_file:
+        csv.writer(csv_file).writerows(csv_rows)
+        csv_path = csv_file.name
+    bin_path = csv_path.replace('.csv', '.bin')
+    try:
+        cmd = [sys.executable, '-m', 'esp_idf_nvs_partition_gen.nvs_partition_gen',
+               'generate', csv_path, bin_path, hex(size)]
+        subprocess.run(cmd, capture_output=True, check=True, timeout=60)
+        with open(bin_path, 'rb') as f:
+            return f.read()
+    finally:
+        for path in (csv_path, bin_path):
+            try: os.unlink(path)
+            except OSError: pass
+
+
+def large_rows(entries):
+    """Synthetic partition: mostly u32, every 10th a string, every 100th a 2 KB blob."""
+    rows = [['key', 'type', 'encoding', 'value']]
+    for i in range(entries):
+        if i % 5000 == 0:
+            rows.append([f"cal{i // 5000}", 'namespace', '', ''])
+        if i % 100 == 0:
+            rows.append([f"b{i}", 'data', 'hex2bin', bytes([i % 256]).hex() * 2048])
+        elif i % 10 == 0:
+            rows.append([f"s{i}", 'data', 'string', f"serial-{i:010d}-" * 3])
+        else:
+            rows.append([f"k{i}", 'data', 'u32', str(i)])
+    # ~1.9 entries per row on average, plus slack and the reserved page
+    return rows, (entries * 2 // 120 + 4) * 4096
+
+
+def bench_writer(sizes):
+    for entries in sizes:
+        rows, size = large_rows(entries)
+        timings = {}
+        for engine in ('reference', 'fast'):
+            runs = 5 if entries <= 10000 else 1
+            start = time.perf_counter()
+            for _ in range(runs):
+                image = _generate_nvs_bytes(rows, size, engine=engine)
+            timings[engine] = ((time.perf_counter() - start) * 1000 / runs, image)
+        assert timings['reference'][1] == timings['fast'][1], f"writer mismatch at {entries} entries"
+        ref_ms, fast_ms = timings['reference'][0], timings['fast'][0]
+        print(f"{entries:>7} entries  {size // 1024:>6} KB   reference={ref_ms:10.1f} ms   "
+              f"fast={fast_ms:8.1f} ms   x{ref_ms / fast_ms:.1f}")
+
+
+def measure(fn, iterations):
+    """Return per-call latencies in milliseconds."""
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def report(name, samples):
+    cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    print(f"{name:<14} n={len(samples):<5} p50={cuts[49]:9.3f} ms   p99={cuts[98]:9.3f} ms")
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'writer':
+        bench_writer([int(n) for n in sys.argv[2:]] or [100, 10000, 100000])
+        return
+
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+    # Both paths must produce the same partition before timing means anything
+    assert _generate_nvs_bytes(SAMPLE_ROWS) == generate_subprocess(SAMPLE_ROWS), "outputs differ"
+
+    report('subprocess', measure(lambda: generate_subprocess(SAMPLE_ROWS), max(iterations // 5, 5)))
+    report('in-process', measure(lambda: _generate_nvs_bytes(SAMPLE_ROWS), iterations))
+
+    rng = random.Random(1)
+    devices = [_device_nvs_rows(f"BonicBotS1-{n:04d}", 'S1 Lite', str(rng.randint(900, 1100)), '1000')
+               for n in range(iterations)]
+    rendered = iter(devices)
+    report('template', measure(lambda: _render_nvs(next(rendered)), iterations))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+FirmwareStore refcounting and quota eviction. Each test works on its own store under tmp_path;
+version files are written the way fetch_release leaves them (versions/<v>.bin plus sidecars).
+"""
+import os
+import sys
+from threading import Lock
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+from app import FirmwareStore  # noqa: E402
+
+SIZE = 1000
+
+
+@pytest.fixture
+def store(tmp_path):
+    return FirmwareStore(root=str(tmp_path / 'store'), quota=10 * SIZE, policy='oldest')
+
+
+def add_version(store, tmp_path, bot, version, fill):
+    """Write versions/<version>.bin of one repeated byte (same fill -> same blob) and add it."""
+    path = tmp_path / bot / 'versions' / f'{version}.bin'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(fill * SIZE)
+    for suffix in ('.sha256', '.md5'):
+        (tmp_path / bot / 'versions' / f'{version}.bin{suffix}').write_text('x')
+    store.add(bot, 'version', version, str(path))
+    return str(path)
+
+
+def evicted_versions(evicted):
+    return [(entry['bot'], entry['version']) for entry in evicted if 'version' in entry]
+
+
+def test_identical_versions_share_one_blob(store, tmp_path):
+    a = add_version(store, tmp_path, 'bot', 'v1', b'A')
+    b = add_version(store, tmp_path, 'bot', 'v2', b'A')
+    assert os.path.samefile(a, b)
+    assert store.stats()['blobs'] == 1
+    assert store.stats()['dedup_saved_bytes'] == SIZE
+
+
+def test_repointing_a_ref_drops_the_unreferenced_blob(store, tmp_path):
+    path = add_version(store, tmp_path, 'bot', 'v1', b'A')
+    old = store.version_sha256('bot', 'v1')
+    with open(path, 'wb') as f:  # a re-published asset under the same tag
+        f.write(b'B' * SIZE)
+    store.add('bot', 'version', 'v1', path)
+    assert store.version_sha256('bot', 'v1') != old
+    assert not os.path.exists(store.blob_path(old))
+    assert store.stats()['blobs'] == 1
+
+
+def test_repointing_keeps_a_blob_other_refs_still_use(store, tmp_path):
+    add_version(store, tmp_path, 'bot', 'v1', b'A')
+    path = add_version(store, tmp_path, 'bot', 'v2', b'A')
+    shared = store.version_sha256('bot', 'v1')
+    with open(path + '.new', 'wb') as f:
+        f.write(b'B' * SIZE)
+    os.replace(path + '.new', path)
+    store.add('bot', 'version', 'v2', path)
+    assert os.path.exists(store.blob_path(shared))
+    assert store.stats()['blobs'] == 2
+
+
+def test_quota_skips_versions_whose_blob_is_shared(store, tmp_path):
+    add_version(store, tmp_path, 'a', 'v1', b'S')
+    add_version(store, tmp_path, 'b', 'v1', b'S')
+    unique = add_version(store, tmp_path, 'a', 'v2', b'U')
+    store.quota = SIZE
+    assert evicted_versions(store.enforce_quota()) == [('a', 'v2')]
+    assert not os.path.exists(unique)
+    assert not os.path.exists(unique + '.sha256')
+    assert store.usage() == SIZE
+    assert store.version_sha256('a', 'v1') and store.version_sha256('b', 'v1')
+
+
+def test_quota_never_evicts_pinned_or_active_versions(store, tmp_path, monkeypatch):
+    pinned = add_version(store, tmp_path, 'bot', 'v1', b'1')
+    active = add_version(store, tmp_path, 'bot', 'v2', b'2')
+    spare = add_version(store, tmp_path, 'bot', 'v3', b'3')
+    assert store.pin('bot', 'v1')
+    monkeypatch.setitem(app.firmware_managers, 'bot', SimpleNamespace(lock=Lock(), current_version='v2'))
+    store.quota = 0
+    assert evicted_versions(store.enforce_quota()) == [('bot', 'v3')]
+    assert os.path.exists(pinned) and os.path.exists(active) and not os.path.exists(spare)
+    assert store.pinned('bot') == ['v1']
+
+
+def test_quota_keeps_refs_passed_in_keep(store, tmp_path):
+    add_version(store, tmp_path, 'bot', 'v1', b'1')
+    add_version(store, tmp_path, 'bot', 'v2', b'2')
+    store.quota = 0
+    assert evicted_versions(store.enforce_quota(keep={('bot', 'v1')})) == [('bot', 'v2')]
+    assert store.version_sha256('bot', 'v1')
+
+
+def test_adopt_of_an_already_linked_file_is_a_no_op(store, tmp_path):
+    path = add_version(store, tmp_path, 'bot', 'v1', b'A')
+    sha256 = store.version_sha256('bot', 'v1')
+    inode = os.stat(path).st_ino
+    assert store.adopt('bot', 'version', 'v1', path) == sha256
+    assert os.stat(path).st_ino == inode
+    assert store.stats()['refs'] == 1 and store.stats()['blobs'] == 1
+
+
+def test_adopt_indexes_a_file_found_on_disk(store, tmp_path):
+    path = tmp_path / 'bot' / 'versions' / 'v1.bin'
+    path.parent.mkdir(parents=True)
+    path.write_bytes(b'A' * SIZE)
+    sha256 = store.adopt('bot', 'version', 'v1', str(path))
+    assert os.path.samefile(store.blob_path(sha256), path)
+    assert store.usage() == SIZE
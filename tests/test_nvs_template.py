@@ -0,0 +1,61 @@
+"""
+Template-and-patch NVS compiler (_render_nvs) must be byte-identical to a full rebuild
+(_generate_nvs_bytes) for every device that fits the partition.
+
+Cases are drawn from seeded generators, so a failure names a seed that reproduces it.
+"""
+import os
+import random
+import string
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import _device_nvs_rows, _generate_nvs_bytes, _render_nvs  # noqa: E402
+
+ALPHABET = string.ascii_letters + string.digits + '-_é'
+MODELS = ['', 'S1', 'S1 Lite', 'BonicBotA2']
+# Entry boundaries (31/32/33 bytes), multi-entry strings and page-spilling lengths
+LENGTHS = [1, 15, 31, 32, 33, 64, 200, 1500, 3999]
+
+
+def random_device_rows(rng):
+    length = rng.choice(LENGTHS)
+    device_id = ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(1, length)))
+    return _device_nvs_rows(device_id, rng.choice(MODELS),
+                            str(rng.randint(-32768, 32767)), str(rng.randint(-32768, 32767)))
+
+
+def fitting_device_rows(rng):
+    """Next random device whose full rebuild fits the partition, with its expected image."""
+    while True:
+        rows = random_device_rows(rng)
+        try:
+            return rows, _generate_nvs_bytes(rows)
+        except ValueError:
+            continue  # e.g. a multi-byte device_id too long for one page; not a template case
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_template_matches_full_rebuild(seed):
+    rng = random.Random(seed)
+    for _ in range(50):
+        rows, expected = fitting_device_rows(rng)
+        assert _render_nvs(rows) == expected, f"seed={seed} rows={rows}"
+
+
+@pytest.mark.parametrize('device_id', ['A', 'x' * 31, 'x' * 32, 'x' * 33, 'é' * 16, 'BonicBotS1-0153'])
+@pytest.mark.parametrize('robot_model', MODELS)
+def test_template_matches_full_rebuild_at_boundaries(device_id, robot_model):
+    rows = _device_nvs_rows(device_id, robot_model, '-32768', '32767')
+    assert _render_nvs(rows) == _generate_nvs_bytes(rows)
+
+
+def test_template_rejects_what_full_rebuild_rejects():
+    rows = _device_nvs_rows('é' * 3000, 'S1')
+    with pytest.raises(ValueError):
+        _generate_nvs_bytes(rows)
+    with pytest.raises(ValueError):
+        _render_nvs(rows)